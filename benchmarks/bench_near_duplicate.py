@@ -0,0 +1,54 @@
+import os
+import random
+import sys
+import time
+
+# Add the src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from near_duplicate import SimhashIndex
+from config import DUPLICATE_THRESHOLD
+
+# Query cost of SimhashIndex against the linear scan it replaced, as the corpus grows.
+# Run from src/: python ../benchmarks/bench_near_duplicate.py [threshold]
+
+QUERIES = 1000
+LINEAR_SCAN_LIMIT = 50000
+
+def linear_query(fingerprints, value, threshold):
+    for other in fingerprints:
+        if bin(value ^ other).count('1') <= threshold:
+            return other
+    return None
+
+def main():
+    threshold = int(sys.argv[1]) if len(sys.argv) > 1 else DUPLICATE_THRESHOLD
+    rng = random.Random(121)
+    index = SimhashIndex(threshold)
+    fingerprints = []
+
+    print(f"threshold={threshold}, {QUERIES} queries per corpus size")
+    print(f"{'corpus':>10} {'index us/query':>16} {'linear us/query':>16}")
+    for size in (10000, 50000, 100000, 200000, 400000):
+        while len(fingerprints) < size:
+            value = rng.getrandbits(64)
+            fingerprints.append(value)
+            index.insert(value)
+
+        queries = [rng.getrandbits(64) for _ in range(QUERIES)]
+        start = time.perf_counter()
+        for value in queries:
+            index.query(value)
+        index_us = (time.perf_counter() - start) / QUERIES * 1e6
+
+        linear_us = '-'
+        if size <= LINEAR_SCAN_LIMIT:
+            sample = queries[:50]
+            start = time.perf_counter()
+            for value in sample:
+                linear_query(fingerprints, value, threshold)
+            linear_us = f"{(time.perf_counter() - start) / len(sample) * 1e6:.1f}"
+
+        print(f"{size:>10} {index_us:>16.1f} {linear_us:>16}")
+
+if __name__ == "__main__":
+    main()
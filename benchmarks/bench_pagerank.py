@@ -0,0 +1,46 @@
+import os
+import random
+import sys
+import time
+
+# Add the src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from page_rank import compute_pagerank, compute_pagerank_sparse
+
+# Dict-based PageRank against the CSR implementation on a random link graph.
+# Run from src/: python ../benchmarks/bench_pagerank.py [nodes] [avg_out_degree]
+
+def random_graph(nodes, avg_out_degree, rng):
+    links_graph = {}
+    for doc_id in range(1, nodes + 1):
+        # About 10% dangling pages, the rest link to a random set of pages
+        if rng.random() < 0.1:
+            links_graph[doc_id] = []
+            continue
+        targets = {rng.randint(1, nodes) for _ in range(rng.randint(1, 2 * avg_out_degree))}
+        targets.discard(doc_id)
+        links_graph[doc_id] = list(targets)
+    return links_graph
+
+def main():
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    avg_out_degree = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    links_graph = random_graph(nodes, avg_out_degree, random.Random(121))
+    edges = sum(len(v) for v in links_graph.values())
+
+    start = time.perf_counter()
+    dict_scores = compute_pagerank(links_graph, tolerance=1.0e-12)
+    dict_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    csr_scores = compute_pagerank_sparse(links_graph, tolerance=1.0e-12)
+    csr_time = time.perf_counter() - start
+
+    max_diff = max(abs(dict_scores[doc_id] - csr_scores[doc_id]) for doc_id in dict_scores)
+    print(f"Graph: {nodes} nodes, {edges} edges")
+    print(f"Dict PageRank: {dict_time:.3f} s")
+    print(f"CSR PageRank:  {csr_time:.3f} s")
+    print(f"Speedup: {dict_time / csr_time:.1f}x, max abs difference: {max_diff:.2e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+import time
+
+# Add the src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from bs4 import BeautifulSoup
+from tokenizer import Tokenizer
+from document import analyze_document, extract_outbound_links
+from config import DATA_DIR
+
+# Compares the previous three-parse path with analyze_document.
+# Run from src/: python ../benchmarks/bench_parse.py [max_pages] [parser]
+
+def load_pages(limit):
+    pages = []
+    for root, dirs, files in os.walk(DATA_DIR):
+        for file in sorted(files):
+            with open(os.path.join(root, file), 'r', encoding='utf-8', errors='ignore') as f:
+                data = json.load(f)
+            pages.append((data.get('url', ''), data.get('content', '')))
+            if len(pages) >= limit:
+                return pages
+    return pages
+
+def three_parse(content, url, tokenizer):
+    sim_soup = BeautifulSoup(content, 'html.parser')
+    for tag in sim_soup(['script', 'style', 'header', 'footer', 'nav', 'aside', 'form', 'noscript']):
+        tag.decompose()
+    text = ' '.join(sim_soup.stripped_strings)
+    tokens = tokenizer.tokenize_with_positions_and_weights(content)
+    links = extract_outbound_links(content, url, 'html.parser')
+    return text, tokens, links
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    parser = sys.argv[2] if len(sys.argv) > 2 else 'html.parser'
+    pages = load_pages(limit)
+    if not pages:
+        print(f"No pages found under {DATA_DIR}")
+        return
+    tokenizer = Tokenizer()
+
+    start = time.perf_counter()
+    baseline = [three_parse(content, url, tokenizer) for url, content in pages]
+    three_parse_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    analyses = [analyze_document(content, url, tokenizer, parser) for url, content in pages]
+    single_parse_time = time.perf_counter() - start
+
+    mismatches = 0
+    for (text, tokens, links), analysis in zip(baseline, analyses):
+        if text != analysis.text or tokens != analysis.tokens or sorted(links) != sorted(analysis.outbound_links):
+            mismatches += 1
+
+    print(f"Pages: {len(pages)}")
+    print(f"Three parses (html.parser): {len(pages) / three_parse_time:.1f} docs/sec")
+    print(f"Single parse ({parser}): {len(pages) / single_parse_time:.1f} docs/sec")
+    print(f"Speedup: {three_parse_time / single_parse_time:.2f}x")
+    print(f"Pages with different output: {mismatches}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import io
+import os
+import random
+import sys
+import time
+
+# Add the src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from postings import encode_postings, decode_postings
+
+# Size and decode speed of the binary posting format against the previous text lines.
+# Positions are decoded on demand, so the binary format is timed both without them
+# (single-term queries, documents missing a term) and with every posting's positions.
+# Run from src/: python ../benchmarks/bench_postings.py [postings]
+
+def make_postings(count, rng):
+    postings = []
+    doc_id = 0
+    for _ in range(count):
+        doc_id += rng.randint(1, 20)
+        positions = sorted(rng.sample(range(5000), rng.randint(1, 12)))
+        postings.append([doc_id, rng.random() * 5, positions])
+    return postings
+
+def encode_text(postings):
+    lines = []
+    for posting in postings:
+        positions = ''.join(f" {p}" for p in posting[2])
+        lines.append(f"{posting[0]},{posting[1]},{positions}\n")
+    return ''.join(lines)
+
+def decode_text(text, length):
+    file = io.StringIO(text)
+    data_fetched = []
+    for _ in range(length):
+        parts = file.readline().split(",")
+        data_fetched.append([int(parts[0]), float(parts[1]), list(map(int, parts[2].strip().split()))])
+    return data_fetched
+
+def best_of(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    postings = make_postings(count, random.Random(121))
+    text = encode_text(postings)
+    data, positions = encode_postings(postings)
+    positions = memoryview(positions)
+    binary_size = len(data) + len(positions)
+
+    text_time = best_of(lambda: decode_text(text, count))
+    binary_time = best_of(lambda: decode_postings(data, positions))
+    positions_time = best_of(lambda: decode_postings(data, positions).to_lists())
+
+    print(f"Postings: {count}")
+    print(f"Text:   {len(text.encode('utf-8')) / 1024:.1f} KB, decode {text_time * 1000:.2f} ms")
+    print(f"Binary: {binary_size / 1024:.1f} KB ({len(positions) / 1024:.1f} KB positions), "
+          f"decode {binary_time * 1000:.2f} ms, {positions_time * 1000:.2f} ms with all positions")
+    print(f"Size ratio: {len(text.encode('utf-8')) / binary_size:.2f}x, decode speedup: {text_time / binary_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
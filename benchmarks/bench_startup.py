@@ -0,0 +1,79 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# Add the src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from stores import DocStore, PageRankStore, TermTable, write_doc_store, write_pagerank_store, write_term_table
+
+# Cold-start time and RSS of loading the doc mapping, PageRank and offset table
+# as JSON dicts (the old startup) against the lazily mapped binary stores.
+# Each variant runs in a fresh interpreter.
+# Run from src/: python ../benchmarks/bench_startup.py [documents] [terms]
+
+def build_files(directory, documents, terms):
+    rng = random.Random(121)
+    doc_mapping = {doc_id: f"https://www.ics.uci.edu/page/{doc_id}/{rng.getrandbits(32):x}.html" for doc_id in range(1, documents + 1)}
+    pagerank_scores = {doc_id: rng.random() / documents for doc_id in doc_mapping}
+    offsets = {f"term{n:07d}": [n * 40, 40, rng.random(), rng.randint(1, documents)] for n in range(terms)}
+
+    with open(os.path.join(directory, 'doc_mapping.json'), 'w') as f:
+        json.dump(doc_mapping, f)
+    with open(os.path.join(directory, 'page_rank.json'), 'w') as f:
+        json.dump(pagerank_scores, f, indent=2)
+    with open(os.path.join(directory, 'token_retrieval_offset.json'), 'w') as f:
+        json.dump(offsets, f)
+
+    write_doc_store(doc_mapping, os.path.join(directory, 'doc_mapping.bin'))
+    write_pagerank_store(pagerank_scores, documents + 1, os.path.join(directory, 'page_rank.bin'))
+    write_term_table(offsets, os.path.join(directory, 'token_retrieval_offset.bin'))
+
+def current_rss_kb():
+    # ru_maxrss survives exec on Linux and would report the parent's peak, so read VmRSS
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def load(mode, directory):
+    start = time.perf_counter()
+    if mode == 'json':
+        with open(os.path.join(directory, 'doc_mapping.json')) as f:
+            doc_map = json.load(f)
+        with open(os.path.join(directory, 'page_rank.json')) as f:
+            pagerank_scores = json.load(f)
+        with open(os.path.join(directory, 'token_retrieval_offset.json')) as f:
+            offsets = json.load(f)
+        # One query's worth of lookups
+        doc_map['1'], pagerank_scores.get('1', 0.0), offsets.get('term0000001')
+    else:
+        doc_map = DocStore(os.path.join(directory, 'doc_mapping.bin'))
+        pagerank_scores = PageRankStore(os.path.join(directory, 'page_rank.bin'))
+        offsets = TermTable(os.path.join(directory, 'token_retrieval_offset.bin'))
+        doc_map[1], pagerank_scores.get(1), offsets.get('term0000001')
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'seconds': elapsed, 'rss_kb': current_rss_kb()}))
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        load(sys.argv[2], sys.argv[3])
+        return
+
+    documents = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    terms = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    with tempfile.TemporaryDirectory() as directory:
+        build_files(directory, documents, terms)
+        print(f"{documents} documents, {terms} terms")
+        for mode in ('json', 'binary'):
+            output = subprocess.run([sys.executable, __file__, '--child', mode, directory],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output)
+            print(f"{mode:>7}: startup {result['seconds'] * 1000:9.1f} ms, RSS {result['rss_kb'] / 1024:8.1f} MB")
+
+if __name__ == "__main__":
+    main()
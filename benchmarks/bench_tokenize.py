@@ -0,0 +1,97 @@
+import json
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+
+# Add the src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from document import make_soup
+from tokenizer import Tokenizer, REMOVED_TAGS
+from config import DATA_DIR
+
+# Tokenizes the fields of crawl pages with the cached stemmer and per-page word table of
+# Tokenizer.tokenize_fields, against the previous path that stemmed every occurrence of
+# every field again. The pages are parsed up front, so only tokenizing is timed.
+# Run from src/: python ../benchmarks/bench_tokenize.py [max_pages]
+
+def load_pages(limit):
+    pages = []
+    for root, dirs, files in os.walk(DATA_DIR):
+        for file in sorted(files):
+            with open(os.path.join(root, file), 'r', encoding='utf-8', errors='ignore') as f:
+                data = json.load(f)
+            pages.append(data.get('content', ''))
+            if len(pages) >= limit:
+                return pages
+    return pages
+
+def page_fields(content, tokenizer):
+    soup = make_soup(content)
+    for tag in soup(REMOVED_TAGS):
+        tag.decompose()
+    return tokenizer.extract_fields(soup)
+
+def uncached_tokenize_fields(tokenizer, fields):
+    # The tokenizer before the stem cache
+    def tokenize_and_filter(text):
+        return [tokenizer.ps.stem(tok) for tok in re.findall(r'\b[a-zA-Z0-9]+\b', text.lower())]
+
+    title_set = set(tokenize_and_filter(fields['title']))
+    h1_set = set(tokenize_and_filter(fields['h1']))
+    h2_set = set(tokenize_and_filter(fields['h2']))
+    h3_set = set(tokenize_and_filter(fields['h3']))
+    bold_set = set(tokenize_and_filter(fields['bold']))
+    main_tokens = tokenize_and_filter(fields['main'])
+
+    token_data = defaultdict(lambda: {"weight": 0.0, "positions": []})
+    for i, t in enumerate(main_tokens):
+        candidate_weights = []
+        if t in title_set:
+            candidate_weights.append(tokenizer.title_weight)
+        if t in h1_set:
+            candidate_weights.append(tokenizer.h1_weight)
+        if t in h2_set:
+            candidate_weights.append(tokenizer.h2_weight)
+        if t in h3_set:
+            candidate_weights.append(tokenizer.h3_weight)
+        if t in bold_set:
+            candidate_weights.append(tokenizer.bold_weight)
+        if candidate_weights:
+            occurrence_weight = tokenizer.main_weight + max(candidate_weights)
+        else:
+            occurrence_weight = tokenizer.main_weight
+        token_data[t]["weight"] += occurrence_weight
+        token_data[t]["positions"].append(i)
+    return {tok: (d["weight"], d["positions"]) for tok, d in token_data.items()}
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    reference = Tokenizer()
+    pages = [page_fields(content, reference) for content in load_pages(limit)]
+    if not pages:
+        print(f"No pages found under {DATA_DIR}")
+        return
+    words = sum(len(fields['main'].split()) for fields in pages)
+
+    start = time.perf_counter()
+    baseline = [uncached_tokenize_fields(reference, fields) for fields in pages]
+    uncached_time = time.perf_counter() - start
+
+    # A new tokenizer, so the stem cache starts empty like in an indexer worker
+    tokenizer = Tokenizer()
+    start = time.perf_counter()
+    results = [tokenizer.tokenize_fields(fields) for fields in pages]
+    cached_time = time.perf_counter() - start
+
+    mismatches = sum(1 for expected, result in zip(baseline, results) if expected != result)
+    stats = tokenizer.stems.stats()
+    print(f"Pages: {len(pages)}, about {words} words")
+    print(f"Stemming every occurrence: {len(pages) / uncached_time:.1f} docs/sec")
+    print(f"Cached stems:              {len(pages) / cached_time:.1f} docs/sec ({uncached_time / cached_time:.1f}x)")
+    print(f"Stem cache: {stats['entries']} words, {stats['hit_rate']:.1%} of {stats['hits'] + stats['misses']} lookups hit")
+    print(f"Pages with different tokens: {mismatches}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# Add the src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from search import Searcher, STAGES
+from query_cache import LRUCache
+from config import SEARCH_MODE
+
+# Replays a query log (one query per line) against the index in ../segments (or the
+# shards) and reports latency percentiles, throughput and where the time went.
+# --save keeps the run, --baseline compares against a saved one: the exit status is 1
+# if any ranking changed or p95 latency grew beyond --max-slowdown.
+# Run from src/: python ../benchmarks/replay.py queries.txt --save before.json
+
+def read_queries(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+def replay(searcher, queries, limit, mode, batch_size, detailed):
+    # Rankings, per request latencies and summed stage timings
+    results = {}
+    latencies = []
+    timings = {}
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        batch = queries[i:i + batch_size]
+        request_start = time.perf_counter()
+        answers = searcher.search_batch(batch, limit, mode, timings, detailed=detailed)
+        latencies.append(time.perf_counter() - request_start)
+        for query, (urls, _) in zip(batch, answers):
+            results[query] = [url for url, _ in urls]
+    elapsed = time.perf_counter() - start
+    return results, latencies, timings, elapsed
+
+def summarize(queries, latencies, timings, elapsed):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'queries': len(queries),
+        'seconds': elapsed,
+        'qps': len(queries) / elapsed if elapsed else 0.0,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'max_ms': float(latencies_ms.max()),
+        # Milliseconds per query spent in each stage
+        'stages_ms': {stage: timings[stage] * 1000 / len(queries) for stage in STAGES if stage in timings},
+    }
+
+def print_summary(summary, batch_size):
+    unit = 'batch' if batch_size > 1 else 'query'
+    print(f"{summary['queries']} queries in {summary['seconds']:.2f} s, {summary['qps']:.1f} QPS")
+    print(f"Latency per {unit}: p50 {summary['p50_ms']:.2f} ms, p95 {summary['p95_ms']:.2f} ms, "
+          f"p99 {summary['p99_ms']:.2f} ms, max {summary['max_ms']:.2f} ms")
+    print("Time per query by stage (see search.STAGES):")
+    for stage, ms in summary['stages_ms'].items():
+        print(f"  {stage:>8}: {ms:8.3f} ms")
+
+def compare(run, baseline, max_slowdown):
+    # Number of problems found against the baseline run
+    problems = 0
+    changed = [query for query, urls in run['results'].items()
+               if query in baseline['results'] and baseline['results'][query] != urls]
+    missing = [query for query in run['results'] if query not in baseline['results']]
+    print(f"Rankings: {len(changed)} of {len(run['results'])} queries differ from the baseline")
+    for query in changed[:5]:
+        print(f"  {query!r}")
+    if missing:
+        print(f"  {len(missing)} queries are not in the baseline")
+    problems += len(changed)
+
+    for key in ('qps', 'p50_ms', 'p95_ms', 'p99_ms'):
+        before, after = baseline['summary'][key], run['summary'][key]
+        change = (after / before - 1) * 100 if before else 0.0
+        print(f"  {key:>7}: {before:10.2f} -> {after:10.2f} ({change:+.1f}%)")
+    if run['settings'] != baseline['settings']:
+        # A batch's latency is that of all its queries, a cached run skips the engine
+        print(f"Settings differ from the baseline ({baseline['settings']}), latency is not checked")
+    elif run['summary']['p95_ms'] > baseline['summary']['p95_ms'] * max_slowdown:
+        print(f"p95 latency grew more than {max_slowdown}x")
+        problems += 1
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a query log against the index")
+    parser.add_argument('log', help="file with one query per line")
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--mode', default=SEARCH_MODE)
+    parser.add_argument('--batch', type=int, default=1, help="queries per search_batch call")
+    parser.add_argument('--repeat', type=int, default=1, help="times the log is replayed")
+    parser.add_argument('--warmup', type=int, default=0, help="queries run before measuring")
+    parser.add_argument('--cache', action='store_true', help="keep the result cache on")
+    parser.add_argument('--detail', action='store_true', help="also time proximity and PageRank within scoring (slower)")
+    parser.add_argument('--save', help="write rankings and summary to this file")
+    parser.add_argument('--baseline', help="compare against a file written by --save")
+    parser.add_argument('--max-slowdown', type=float, default=1.2)
+    args = parser.parse_args()
+
+    queries = read_queries(args.log)
+    if not queries:
+        print(f"No queries in {args.log}")
+        return
+    searcher = Searcher()
+    if not args.cache:
+        # Repeated queries would be measured as cache hits
+        searcher.query_cache = LRUCache(0)
+    for query in queries[:args.warmup]:
+        searcher.search(query, args.limit, args.mode)
+
+    replayed = queries * args.repeat
+    results, latencies, timings, elapsed = replay(searcher, replayed, args.limit, args.mode, args.batch, args.detail)
+    summary = summarize(replayed, latencies, timings, elapsed)
+    print(f"Mode {args.mode}, limit {args.limit}, batches of {args.batch}")
+    print_summary(summary, args.batch)
+
+    run = {
+        'settings': {'log': args.log, 'limit': args.limit, 'mode': args.mode, 'batch': args.batch,
+                     'cache': args.cache, 'detail': args.detail},
+        'summary': summary,
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(run, f, indent=1)
+        print(f"Run saved to {args.save}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(run, baseline, args.max_slowdown):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
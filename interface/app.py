@@ -1,17 +1,49 @@
-from flask import Flask, render_template, request
+from flask import Flask, Response, jsonify, render_template, request
 import sys
 import os
+import time
 
 # Add the src directory to the Python path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
-from search import search_with_query, pre_loading_files
+from search import Searcher
+from metrics import REGISTRY, profile_call
+from config import SEARCH_MODE, MAX_RESULT_LIMIT, MAX_BATCH_QUERIES, PROFILING_ENABLED
 
 app = Flask(__name__)
 
-pre_loading_files()
+# One Searcher serves every request thread. Under gunicorn (see gunicorn.conf.py) it
+# is created before the workers are forked, so they share the mapped index.
+searcher = Searcher()
 
-def perform_search(query):
-    return search_with_query(query)
+def cache_stat(cache, stat):
+    return lambda: (searcher.cache_stats()[cache] or {}).get(stat, 0)
+
+for cache in ('queries', 'postings', 'stems'):
+    for stat in ('entries', 'size'):
+        REGISTRY.gauge(f'search_{cache}_cache_{stat}', f"{stat.capitalize()} of the {cache} cache", cache_stat(cache, stat))
+    # Lookups only ever add up, so they are counters that rate() works on
+    for stat in ('hits', 'misses'):
+        REGISTRY.counter(f'search_{cache}_cache_{stat}_total', f"{stat.capitalize()} of the {cache} cache", function=cache_stat(cache, stat))
+
+def result_dicts(urls):
+    return [{'url': url, 'title': url.split('/')[-1] or url, 'score': float(score)} for url, score in urls]
+
+def perform_search(query, limit=100, mode=SEARCH_MODE):
+    urls, cached = searcher.search(query, limit, mode)
+    return result_dicts(urls), cached
+
+def search_options(args):
+    # (limit, mode, error message) from request arguments
+    mode = args.get('mode', SEARCH_MODE)
+    try:
+        limit = int(args.get('limit', 100))
+    except (TypeError, ValueError):
+        limit = 0
+    if not 1 <= limit <= MAX_RESULT_LIMIT:
+        return limit, mode, f"limit must be an integer from 1 to {MAX_RESULT_LIMIT}"
+    if mode not in ('tiered', 'maxscore', 'vectorized', 'exhaustive', 'phrase'):
+        return limit, mode, f"unknown mode {mode}"
+    return limit, mode, None
 
 @app.route('/')
 def home():
@@ -21,10 +53,69 @@ def home():
 def search():
     query = request.args.get('q', '')
     if query:
-        results = perform_search(query)
+        results, _ = perform_search(query)
     else:
         results = []
     return render_template('results.html', query=query, results=results)
 
+@app.route('/api/search')
+def api_search():
+    # GET /api/search?q=<query>&limit=<1..MAX_RESULT_LIMIT>&mode=<SEARCH_MODE>
+    # With PROFILING_ENABLED, profile=1 bypasses the result cache and adds the time per
+    # stage and a cProfile report of the search to the answer.
+    query = request.args.get('q', '')
+    limit, mode, error = search_options(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+
+    start_time = time.perf_counter()
+    answer = {'query': query, 'limit': limit}
+    if PROFILING_ENABLED and request.args.get('profile') == '1':
+        timings = {}
+        (urls, cached), report = profile_call(searcher.search, query, limit, mode, timings, use_cache=False, detailed=True)
+        results = result_dicts(urls)
+        answer['stages_ms'] = {stage: seconds * 1000 for stage, seconds in timings.items()}
+        answer['profile'] = report
+    else:
+        results, cached = perform_search(query, limit, mode) if query.strip() else ([], False)
+    answer.update({
+        'results': results,
+        'cached': cached,
+        'took_ms': (time.perf_counter() - start_time) * 1000,
+    })
+    return jsonify(answer)
+
+@app.route('/api/search/batch', methods=['POST'])
+def api_search_batch():
+    # POST {"queries": [...], "limit": n, "mode": m}, answers in the order of the queries.
+    # Postings of terms shared by several queries are read once for the batch.
+    body = request.get_json(silent=True) or {}
+    queries = body.get('queries')
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return jsonify({'error': "queries must be a list of strings"}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({'error': f"at most {MAX_BATCH_QUERIES} queries per batch"}), 400
+    limit, mode, error = search_options(body)
+    if error:
+        return jsonify({'error': error}), 400
+
+    start_time = time.perf_counter()
+    answers = searcher.search_batch(queries, limit, mode)
+    return jsonify({
+        'limit': limit,
+        'results': [{'query': query, 'results': result_dicts(urls), 'cached': cached}
+                    for query, (urls, cached) in zip(queries, answers)],
+        'took_ms': (time.perf_counter() - start_time) * 1000,
+    })
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format, for this worker process
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache_stats')
+def cache_statistics():
+    return jsonify(searcher.cache_stats())
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    app.run(debug=True, port=5001)
@@ -0,0 +1,16 @@
+import os
+
+# Pre-fork serving of app.py:
+#   cd interface
+#   gunicorn -c gunicorn.conf.py app:app
+# The app, and with it the index, is loaded once before forking. The index files are
+# memory mapped, so all workers read the same page cache pages instead of each
+# holding a copy, and each worker answers requests on several threads.
+
+bind = os.environ.get('SEARCH_BIND', '0.0.0.0:5000')
+preload_app = True
+workers = os.cpu_count() or 1
+worker_class = 'gthread'
+threads = 4
+keepalive = 5
+accesslog = None
@@ -1,19 +1,19 @@
-import os
-from utils import load_json, get_file_size_kb
-from config import FINAL_INDEX_DIR, DOC_MAPPING_FILE
+from utils import get_file_size_kb
+from segments import open_index, all_terms, index_directories, index_docs
 
 def calculate_metrics():
+    directories = index_directories()
+    indexes = [open_index(directory) for directory in directories]
+    shard_segments = [segments for _, segments, _ in indexes]
+
     # Number of Indexed Documents
-    doc_mapping = load_json(DOC_MAPPING_FILE)
-    num_documents = len(doc_mapping)
+    num_documents = len(index_docs(shard_segments)) - sum(len(tombstones) for _, _, tombstones in indexes)
 
     # Number of Unique Tokens
-    final_index_path = os.path.join(FINAL_INDEX_DIR, 'final_inverted_index.json')
-    final_index = load_json(final_index_path)
-    num_unique_tokens = len(final_index)
+    num_unique_tokens = sum(1 for _ in all_terms([segment for segments in shard_segments for segment in segments]))
 
     # Total Size of Index on Disk
-    index_size_kb = get_file_size_kb(FINAL_INDEX_DIR)
+    index_size_kb = sum(get_file_size_kb(directory) for directory in directories)
 
     # Print Metrics
     print(f"Number of Indexed Documents: {num_documents}")
@@ -0,0 +1,120 @@
+import math
+import os
+import sys
+import time
+import logging
+import numpy as np
+from index_reader import IndexReader
+from postings import concat_postings
+from segments import SegmentWriter, SegmentDocs, open_index, all_terms, publish, index_directories
+from stores import PageRankStore
+from utils import setup_logging
+from config import LOG_FILE, PAGERANK_FILE, SEGMENTS_DIR, MERGE_FACTOR, MERGE_DELETED_RATIO, COMPACTION_INTERVAL
+
+# Merges neighbouring index segments so a stream of small incremental segments
+# collapses into a few large ones, and drops tombstoned documents on the way.
+#   python compaction.py           merge until the policy has nothing left to do
+#   python compaction.py --watch   keep doing that every COMPACTION_INTERVAL seconds
+#   python compaction.py --full    merge every segment into one
+# A sharded index is compacted shard by shard.
+
+def live_docs(segment, tombstones):
+    deleted = np.count_nonzero((tombstones >= segment.docs.first) & (tombstones < segment.docs.slots))
+    return len(segment.docs) - deleted
+
+def segment_level(docs):
+    # Segments within a factor of MERGE_FACTOR in live documents share a level
+    return int(math.log(max(docs, 1), MERGE_FACTOR))
+
+def find_merge(segments, tombstones):
+    # (start, end) of the segments to merge next, or None.
+    # MERGE_FACTOR neighbours on the same level are merged, the newest (smallest) first,
+    # so a segment is rewritten about log(N) times over its life. A segment that lost
+    # MERGE_DELETED_RATIO of its documents is rewritten on its own.
+    live = [live_docs(segment, tombstones) for segment in segments]
+    levels = [segment_level(docs) for docs in live]
+    for end in range(len(segments), MERGE_FACTOR - 1, -1):
+        window = levels[end - MERGE_FACTOR:end]
+        if min(window) == max(window):
+            return end - MERGE_FACTOR, end
+    for i, segment in enumerate(segments):
+        if len(segment.docs) and 1 - live[i] / len(segment.docs) >= MERGE_DELETED_RATIO:
+            return i, i + 1
+    return None
+
+def merge_segments(segments, tombstones, start, end, directory=SEGMENTS_DIR):
+    merged = segments[start:end]
+    names = [segment.name for segment in merged]
+    first, slots = merged[0].docs.first, merged[-1].docs.slots
+    # Tombstones of the merged documents are dropped with them, later ones are kept
+    dropped = set(t for t in tombstones.tolist() if first <= t < slots)
+
+    doc_mapping = {doc_id: url for doc_id, url in SegmentDocs(merged).items() if doc_id not in dropped}
+    print(f"Merging {', '.join(names)} ({len(doc_mapping)} documents)...")
+
+    segment_directory = None
+    if doc_mapping:
+        # idf over the whole index (or shard) orders the champion tiers, like a fresh build would
+        reader = IndexReader(segments, tombstones)
+        pagerank_scores = PageRankStore(PAGERANK_FILE) if os.path.exists(PAGERANK_FILE) else None
+        writer = SegmentWriter(directory)
+        try:
+            for token in all_terms(merged):
+                located = reader.locate(token)
+                parts = [reader.read(segment, location_info[0:2]) for segment, location_info in located if segment in merged]
+                postings = concat_postings(parts)
+                if len(postings):
+                    writer.add(token, postings.to_lists(), pagerank_scores, reader.idf(located))
+            segment_directory = writer.finish(doc_mapping)
+        except Exception:
+            writer.discard()
+            raise
+
+    def replace_merged(current, new_name):
+        segment_names = current['segments']
+        if names[0] not in segment_names:
+            raise RuntimeError("Segments were replaced while merging, the merge is discarded")
+        i = segment_names.index(names[0])
+        if segment_names[i:i + len(names)] != names:
+            raise RuntimeError("Segments were replaced while merging, the merge is discarded")
+        return segment_names[:i] + ([new_name] if new_name else []) + segment_names[i + len(names):]
+
+    new_manifest = publish(replace_merged, segment_directory,
+                           lambda current: [t for t in current.tolist() if t not in dropped], directory)
+    print(f"Index generation {new_manifest['generation']}: {', '.join(new_manifest['segments'])}")
+
+def run_merges():
+    for directory in index_directories():
+        while True:
+            manifest, segments, tombstones = open_index(directory)
+            merge = find_merge(segments, tombstones)
+            if merge is None:
+                break
+            merge_segments(segments, tombstones, *merge, directory)
+
+def full_merge():
+    for directory in index_directories():
+        manifest, segments, tombstones = open_index(directory)
+        if len(segments) <= 1 and not len(tombstones):
+            print(f"Nothing to compact in {directory}")
+            continue
+        merge_segments(segments, tombstones, 0, len(segments), directory)
+
+def watch():
+    print(f"Checking for segments to merge every {COMPACTION_INTERVAL} seconds")
+    while True:
+        try:
+            run_merges()
+        except Exception as e:
+            print(f"Merge failed: {e}")
+            logging.error(f"Merge failed: {e}")
+        time.sleep(COMPACTION_INTERVAL)
+
+if __name__ == "__main__":
+    setup_logging(LOG_FILE)
+    if sys.argv[1:] == ['--watch']:
+        watch()
+    elif sys.argv[1:] == ['--full']:
+        full_merge()
+    else:
+        run_merges()
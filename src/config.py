@@ -3,18 +3,40 @@ import os
 # Paths
 DATA_DIR = os.path.join('..', 'data/')
 PARTIAL_INDEX_DIR = os.path.join('..', 'partial_indexes')
-FINAL_INDEX_DIR = os.path.join('..', 'final_index')
-DOC_MAPPING_FILE = os.path.join('..', 'doc_mapping.json')
+DOC_MAPPING_FILE = os.path.join('..', 'doc_mapping.bin')
 LOG_FILE = os.path.join('..', 'indexer.log')
-LINKS_FILE = os.path.join('..', 'links.json')
+LINKS_FILE = os.path.join('..', 'links.bin')
 IDF_FILE = os.path.join('..', 'idf.json')
 DF_FILE = os.path.join("..", 'df.json')
-PAGERANK_FILE = os.path.join("..", 'page_rank.json')
-TOKEN_RETRIEVAL_OFFSET_FILE = os.path.join("..", 'token_retrieval_offset.json')
+PAGERANK_FILE = os.path.join("..", 'page_rank.bin')
+SIMHASH_INDEX_FILE = os.path.join("..", 'simhash_index.bin')
+METRICS_DIR = os.path.join('..', 'metrics') # <script>.prom files with the metrics of the last build run
+SEGMENTS_DIR = os.path.join('..', 'segments')
+SHARDS_DIR = os.path.join('..', 'shards') # Holds shard_<n>/, laid out like SEGMENTS_DIR, when NUM_SHARDS > 1
 
 # Indexing Parameters
-BATCH_SIZE = 6000 # Number of documents per partial index
+INDEX_BUFFER_BYTES = 256 * 1024 * 1024 # Estimated memory of the indexer's postings and its workers' stem caches, postings are written as a partial index when they fill their share
+NUM_WORKERS = os.cpu_count() or 1 # Processes used to parse and tokenize pages and to merge term ranges, 1 disables the pool
+HTML_PARSER = 'html.parser' # BeautifulSoup backend, 'lxml' is faster when installed
+STEM_CACHE_BYTES = 48 * 1024 * 1024 # Estimated memory of each tokenizer's stem cache, 0 stems every word again. The indexer's workers take theirs out of INDEX_BUFFER_BYTES
+DUPLICATE_THRESHOLD = 1 # Max simhash bit distance for two pages to count as near duplicates
+CHAMPION_LIST_SIZE = 500 # Highest impact postings kept in a term's first tier, 0 disables tiers
+MERGE_FACTOR = 4 # Neighbouring segments of the same size tier merged into one
+MERGE_DELETED_RATIO = 0.3 # Share of tombstoned documents that gets a segment rewritten on its own
+COMPACTION_INTERVAL = 60 # Seconds between merge checks of compaction.py --watch
+NUM_SHARDS = 1 # Index partitions by doc_id % NUM_SHARDS, each searched by its own worker; 1 keeps one index
+
+# Search Parameters
+SEARCH_MODE = 'tiered' # 'tiered', 'maxscore', 'vectorized' or 'exhaustive'; 'phrase' matches the terms in order
+QUERY_CACHE_SIZE = 1024 # Result lists kept for repeated queries, 0 disables the cache
+QUERY_CACHE_TTL = 300 # Seconds before a cached result list is recomputed
+POSTINGS_CACHE_BYTES = 64 * 1024 * 1024 # Memory for decoded posting lists of popular terms, 0 disables it
+MAX_RESULT_LIMIT = 1000 # Largest limit the JSON search API accepts
+MAX_BATCH_QUERIES = 100 # Most queries one batch search request may carry
+PROFILING_ENABLED = False # Allows profile=1 on /api/search, which runs the query under cProfile
+SHARD_URLS = [] # shard_server.py addresses, one per shard in shard order; empty starts a local process per shard
+SHARD_TIMEOUT = 10 # Seconds a shard may take to answer one request
 
 # Ensure directories exist
 os.makedirs(PARTIAL_INDEX_DIR, exist_ok=True)
-os.makedirs(FINAL_INDEX_DIR, exist_ok=True)
+os.makedirs(SEGMENTS_DIR, exist_ok=True)
@@ -0,0 +1,88 @@
+import time
+from bs4 import BeautifulSoup, FeatureNotFound
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from tokenizer import REMOVED_TAGS
+from config import HTML_PARSER
+from metrics import add_time
+
+# Removed on top of REMOVED_TAGS before computing the near-duplicate text
+BOILERPLATE_TAGS = ['header', 'aside', 'form', 'noscript']
+
+
+class DocumentAnalysis:
+    def __init__(self, url):
+        self.url = url
+        self.text = ''  # cleaned text used for near-duplicate detection
+        self.fields = {}  # field -> text for title, h1, h2, h3, bold and main
+        self.tokens = {}  # token -> (total_weight, [positions])
+        self.outbound_links = []
+
+
+def make_soup(content, parser=HTML_PARSER):
+    try:
+        return BeautifulSoup(content, parser)
+    except FeatureNotFound:
+        # Faster backends such as lxml are optional
+        return BeautifulSoup(content, 'html.parser')
+
+
+# Ports dropped from urls by normalize_url
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+
+def normalize_url(url):
+    # The form in which documents are deduplicated and links matched to them: scheme
+    # and host in lower case, no default port, '/' for an empty path and no fragment,
+    # since a fragment only points into the page
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    port = DEFAULT_PORTS.get(scheme)
+    if port and netloc.endswith(port):
+        netloc = netloc[:-len(port)]
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def links_from_soup(soup, base_url):
+    # Normalized web links of the page
+    outbound_links = set()
+
+    for a_tag in soup.find_all('a', href=True):
+        href = a_tag['href']
+        full_link = urljoin(base_url, href)
+        if urlsplit(full_link).scheme.lower() not in DEFAULT_PORTS:
+            continue
+        outbound_links.add(normalize_url(full_link))
+
+    return list(outbound_links)
+
+
+def extract_outbound_links(content, base_url, parser=HTML_PARSER):
+    return links_from_soup(make_soup(content, parser), base_url)
+
+
+def analyze_document(content, url, tokenizer, parser=HTML_PARSER, timings=None):
+    # Parse the page once and derive everything the indexer needs from the same tree.
+    # The tree is stripped in stages, so each consumer sees the same tags as before.
+    # timings: dict that gets the seconds of the parse, links, tokenize and text stages
+    analysis = DocumentAnalysis(url)
+    start = time.perf_counter()
+    soup = make_soup(content, parser)
+    start = add_time(timings, 'parse', start)
+
+    analysis.outbound_links = links_from_soup(soup, url)
+    start = add_time(timings, 'links', start)
+
+    for tag in soup(REMOVED_TAGS):
+        tag.decompose()
+    analysis.fields = tokenizer.extract_fields(soup)
+    analysis.tokens = tokenizer.tokenize_fields(analysis.fields)
+    start = add_time(timings, 'tokenize', start)
+
+    for tag in soup(BOILERPLATE_TAGS):
+        tag.decompose()
+    analysis.text = ' '.join(soup.stripped_strings)
+    add_time(timings, 'text', start)
+
+    return analysis
+
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import logging
+import tempfile
+from itertools import chain
+from multiprocessing import Pool
+from document import normalize_url
+from indexer import (process_file, init_worker, memory_budget, bounded_imap, read_links, resolve_links, UrlIds,
+                     LINKS_SPILL, FILES_IN_FLIGHT_PER_WORKER)
+from partial_index import PostingsBuffer, write_run, merged_postings
+from postings import compute_idf_value
+from near_duplicate import SimhashIndex
+from page_rank import save_pagerank
+from segments import SegmentWriter, open_index, publish, update_lock, index_directories, index_docs, shard_of
+from stores import DocStoreWriter, LinkGraph, PageRankStore, write_link_graph
+from utils import setup_logging, save_json, load_json
+from config import (
+    LOG_FILE,
+    LINKS_FILE,
+    DF_FILE,
+    IDF_FILE,
+    PAGERANK_FILE,
+    SIMHASH_INDEX_FILE,
+    PARTIAL_INDEX_DIR,
+    NUM_WORKERS
+)
+
+# Adds new and changed crawl files to an existing index as a new segment (one per
+# shard of a sharded index):
+#   python incremental.py <crawl files or directories>...
+# compaction.py merges the small segments this leaves behind.
+
+def crawl_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    yield os.path.join(root, file)
+        else:
+            yield path
+
+def publish_shard(directory, segment_directory, replaced_doc_ids):
+    # Appends the shard's new segment, if any, and tombstones its replaced documents
+    if segment_directory is None and not replaced_doc_ids:
+        return
+    # The update lock keeps the doc_ids handed out from the manifest read at the start free
+    append_segment = lambda current, new_name: current['segments'] + ([new_name] if new_name else [])
+    new_manifest = publish(append_segment, segment_directory,
+                           lambda current: current.tolist() + list(replaced_doc_ids), directory)
+    print(f"Published {directory} as index generation {new_manifest['generation']}: {', '.join(new_manifest['segments'])}")
+
+def add_documents(paths, num_workers=NUM_WORKERS):
+    setup_logging(LOG_FILE)
+    # One update at a time, from reading the index to replacing the files next to it
+    with update_lock():
+        # Postings runs, doc stores and outbound links are spilled here like the indexer does
+        with tempfile.TemporaryDirectory(prefix='incremental_', dir=PARTIAL_INDEX_DIR) as spill_directory:
+            update_index(paths, num_workers, spill_directory)
+
+def update_index(paths, num_workers, spill_directory):
+    directories = index_directories()
+    indexes = [open_index(directory) for directory in directories]
+    if not any(segments for _, segments, _ in indexes):
+        raise FileNotFoundError("No index found, build one with indexer.py, page_rank.py and merger.py first.")
+
+    docs = index_docs([segments for _, segments, _ in indexes])
+    tombstones = set(t for _, _, shard_tombstones in indexes for t in shard_tombstones.tolist())
+    # Pages are matched by normalized url, like the indexer deduplicates them
+    url_ids = UrlIds()
+    for doc_id, url in docs.items():
+        if doc_id not in tombstones:
+            url_ids.add(normalize_url(url), doc_id)
+    next_doc_id = max(docs.slots, 1)
+    simhash_index = SimhashIndex.load(SIMHASH_INDEX_FILE)
+
+    # Memory is bounded like in the indexer: postings are flushed to sorted runs at
+    # their share of INDEX_BUFFER_BYTES, urls go to a doc store writer per shard and
+    # outbound links to a spill file
+    stem_cache_bytes, postings_bytes = memory_budget(num_workers)
+    postings = PostingsBuffer()
+    run_paths = []
+    doc_stores = [DocStoreWriter(os.path.join(spill_directory, f"doc_mapping_{shard}.bin")) for shard in range(len(directories))]
+    replaced = dict()  # doc_id of the indexed page -> doc_id of its new version
+    seen_urls = UrlIds()
+    added = 0
+    links_spill_path = os.path.join(spill_directory, LINKS_SPILL)
+    links_spill = open(links_spill_path, 'w', encoding='utf-8')
+
+    files = crawl_files(paths)
+    pool = None
+    if num_workers > 1:
+        pool = Pool(num_workers, initializer=init_worker, initargs=(stem_cache_bytes,))
+        results = bounded_imap(pool, process_file, files, num_workers * FILES_IN_FLIGHT_PER_WORKER, chunksize=16)
+    else:
+        init_worker(stem_cache_bytes)
+        results = map(process_file, files)
+
+    print("Indexing crawl files into a new segment...")
+    try:
+        for file_path, parsed, error, _, _ in results:
+            if error:
+                print(f"Error processing file {file_path}: {error}")
+                logging.error(f"Error processing file {file_path}: {error}")
+                continue
+            if parsed is None:
+                continue
+
+            url, hash_value, weighted_tokens, outbound_links = parsed
+            normalized_url = normalize_url(url)
+            if normalized_url in seen_urls:
+                continue
+            seen_urls.add(normalized_url, 0)
+
+            # A changed page that is still a near duplicate (usually of its own indexed
+            # version) keeps the indexed copy
+            if simhash_index.query(hash_value) is not None:
+                print(f"No significant change or a similar file exists, skipping {url}")
+                continue
+            simhash_index.insert(hash_value)
+
+            doc_id = next_doc_id
+            next_doc_id += 1
+            if normalized_url in url_ids:
+                replaced[url_ids[normalized_url]] = doc_id
+            url_ids.add(normalized_url, doc_id)
+            doc_stores[shard_of(doc_id)].add(doc_id, url)
+            added += 1
+
+            # weighted_tokens: token -> (total_weight, [positions])
+            postings.add(doc_id, weighted_tokens)
+            if outbound_links:
+                links_spill.write(json.dumps([doc_id, list(set(outbound_links))]))
+                links_spill.write('\n')
+
+            if postings.nbytes >= postings_bytes:
+                run_paths.append(os.path.join(spill_directory, f"run_{len(run_paths)}.run"))
+                write_run(postings.terms, run_paths[-1])
+                postings = PostingsBuffer()
+    finally:
+        links_spill.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+    if not added:
+        print("No new or changed documents, the index is unchanged")
+        return
+    print(f"{added} documents to add, {len(replaced)} of them replace indexed pages")
+    if len(postings):
+        run_paths.append(os.path.join(spill_directory, f"run_{len(run_paths)}.run"))
+        write_run(postings.terms, run_paths[-1])
+    postings = None
+
+    # Links of replaced pages go away, links to them move to the new version. Links
+    # from already indexed pages to brand new URLs are not known until a full rebuild.
+    # The new link graph and PageRank, which the segments' champion tiers are ordered
+    # by, replace the current ones only once every shard has published.
+    new_links_path = LINKS_FILE + '.new'
+    new_pagerank_path = PAGERANK_FILE + '.new'
+    writers = []
+    try:
+        graph = LinkGraph(LINKS_FILE) if os.path.exists(LINKS_FILE) else None
+        kept_links = ((source, [replaced.get(target, target) for target in targets])
+                      for source, targets in (graph.items() if graph else ()) if source not in replaced)
+        write_link_graph(chain(kept_links, resolve_links(read_links(links_spill_path), url_ids)), new_links_path)
+        if graph:
+            graph.close()
+        print("Links graph updated, recomputing PageRank...")
+        save_pagerank(next_doc_id, new_links_path, new_pagerank_path)
+
+        # df keeps counting replaced documents until the next full build, like the
+        # document count idf is computed from here
+        df_map = load_json(DF_FILE) if os.path.exists(DF_FILE) else {}
+        total_docs = len(docs) + added
+        pagerank_scores = PageRankStore(new_pagerank_path)
+        writers = [SegmentWriter(directory) if len(doc_store) else None for directory, doc_store in zip(directories, doc_stores)]
+        for token, token_postings in merged_postings(run_paths):
+            df_map[token] = df_map.get(token, 0) + len(token_postings)
+            idf = compute_idf_value(df_map[token], total_docs)
+            shard_postings = [[] for _ in writers]
+            for posting in token_postings:
+                shard_postings[shard_of(posting[0])].append(posting)
+            for writer, part in zip(writers, shard_postings):
+                if part:
+                    writer.add(token, part, pagerank_scores, idf)
+
+        # Shards are published one after another, a search in between sees the update
+        # in some of them only
+        for shard, (directory, writer, doc_store) in enumerate(zip(directories, writers, doc_stores)):
+            segment_directory = None
+            if writer:
+                doc_store.finish()
+                segment_directory = writer.finish(doc_store_path=doc_store.filepath)
+            publish_shard(directory, segment_directory, [doc_id for doc_id in replaced if shard_of(doc_id) == shard])
+        os.replace(new_links_path, LINKS_FILE)
+        os.replace(new_pagerank_path, PAGERANK_FILE)
+    except Exception:
+        for writer in writers:
+            if writer:
+                writer.discard()
+        raise
+    finally:
+        for path in (new_links_path, new_pagerank_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    save_json(df_map, DF_FILE)
+    save_json({token: compute_idf_value(df, total_docs) for token, df in df_map.items()}, IDF_FILE)
+    simhash_index.save(SIMHASH_INDEX_FILE)
+    print("Incremental update completed successfully!")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        add_documents(sys.argv[1:])
+    else:
+        print("Usage: python incremental.py <crawl files or directories>...")
@@ -0,0 +1,153 @@
+import time
+import numpy as np
+from parse_file import load_token_data
+from postings import compute_idf_value, weights_to_tfidf, concat_postings
+from query_cache import LRUCache, postings_nbytes
+
+
+class IndexReader:
+    # Serves a term's postings over all segments of the index (see segments.py).
+    # Each segment's list is sliced out of its mapped file, tombstoned documents are
+    # dropped, the lists are joined in segment order and the stored weights become
+    # tf-idf with the df summed over all segments.
+    # Nothing but the thread-safe cache changes after __init__ and reads never seek,
+    # so one reader can be shared by all request threads.
+    # A shard of a sharded index gets the idf of the whole index from the coordinator
+    # through the idf arguments, so its scores match an unsharded index.
+    def __init__(self, segments, tombstones=None, postings_cache_bytes=0):
+        # postings_cache_bytes: budget for keeping lists of frequently queried terms, 0 disables it
+        self.segments = segments
+        self.tombstones = tombstones if tombstones is not None else np.empty(0, dtype=np.int64)
+        self.total_docs = sum(len(segment.docs) for segment in segments)
+        self.postings_cache = LRUCache(postings_cache_bytes, size_of=postings_nbytes)
+
+    def __contains__(self, term):
+        return any(term in segment.terms for segment in self.segments)
+
+    def locate(self, term):
+        # [(segment, offset table entry)] of the segments that have the term
+        located = []
+        for segment in self.segments:
+            location_info = segment.terms.get(term)
+            if location_info is not None:
+                located.append((segment, location_info))
+        return located
+
+    def df(self, located):
+        # The term tables hold each segment's df, so df reads no postings. Tombstoned
+        # documents still count until compaction rewrites their segment.
+        return sum(location_info[3] for _, location_info in located)
+
+    def idf(self, located):
+        return compute_idf_value(self.df(located), self.total_docs)
+
+    def read(self, segment, location_info):
+        postings = load_token_data(segment.buffer(), segment.positions_buffer(), location_info)
+        if len(self.tombstones):
+            deleted = np.isin(postings.doc_ids, self.tombstones)
+            if deleted.any():
+                postings = postings.select(~deleted)
+        return postings
+
+    def combine(self, located, locations, idf, timings=None):
+        # timings: dict that gets the decoding time added under 'decode'
+        start = time.perf_counter()
+        postings = concat_postings([self.read(segment, location_info)
+                                    for (segment, _), location_info in zip(located, locations)])
+        postings = postings.with_scores(weights_to_tfidf(postings.scores, idf)) if len(postings) else None
+        if timings is not None:
+            timings['decode'] = timings.get('decode', 0.0) + time.perf_counter() - start
+        return postings
+
+    def cached(self, key, load):
+        postings = self.postings_cache.get(key)
+        if postings is None:
+            postings = load()
+            if postings is not None:
+                self.postings_cache.put(key, postings)
+        return postings
+
+    def postings(self, term, idf=None, timings=None):
+        return self.cached(('postings', term, idf), lambda: self.load_postings(term, idf, timings))
+
+    def load_postings(self, term, idf=None, timings=None):
+        located = self.locate(term)
+        if not located:
+            return None
+        locations = [location_info[0:2] for _, location_info in located]
+        return self.combine(located, locations, self.idf(located) if idf is None else idf, timings)
+
+    def max_score(self, term, idf=None):
+        # tf-idf of the largest weight, rounded like the scores so it stays an upper bound
+        located = self.locate(term)
+        max_weight = max(location_info[2] for _, location_info in located)
+        idf = self.idf(located) if idf is None else idf
+        return float(weights_to_tfidf(np.array([max_weight], dtype='<f4'), idf)[0])
+
+    def champions(self, term, idf=None, timings=None):
+        # (first tier postings, max score of the postings left out of it), or
+        # (all postings, None) when no segment has a tier for the term.
+        # A segment without a tier contributes its whole list.
+        located = self.locate(term)
+        if not located:
+            return None
+        tails = [location_info[6] for _, location_info in located if len(location_info) == 7]
+        if not tails:
+            postings = self.postings(term, idf, timings)
+            return (postings, None) if postings is not None else None
+
+        idf = self.idf(located) if idf is None else idf
+        locations = [location_info[4:6] if len(location_info) == 7 else location_info[0:2] for _, location_info in located]
+        postings = self.cached(('champions', term, idf), lambda: self.combine(located, locations, idf, timings))
+        tail = float(weights_to_tfidf(np.array([max(tails)], dtype='<f4'), idf)[0])
+        if postings is None:
+            # Every champion was deleted, the tail bound still covers the rest of the list
+            postings = self.combine(located, [location_info[0:2] for _, location_info in located], idf, timings)
+            return (postings, None) if postings is not None else None
+        return postings, tail
+
+    def close(self):
+        self.postings_cache.clear()
+        for segment in self.segments:
+            segment.close()
+
+
+class SharedPostings:
+    # Read-through view of an IndexReader for a batch of queries. Every list it hands
+    # out is kept until the batch ends, so queries sharing a term read and decode it
+    # once even when the postings cache is off or evicts it.
+    # The time spent decoding lists is added to timings['decode'] and the rest of the
+    # lookups (term tables, caches) to timings['fetch']; set timings per query.
+    def __init__(self, reader):
+        self.reader = reader
+        self.timings = {}
+        self.lists = {}
+
+    @property
+    def total_docs(self):
+        return self.reader.total_docs
+
+    def locate(self, term):
+        return self.reader.locate(term)
+
+    def df(self, located):
+        return self.reader.df(located)
+
+    def shared(self, key, load):
+        if key not in self.lists:
+            timings = self.timings
+            start = time.perf_counter()
+            decoded = timings.get('decode', 0.0)
+            self.lists[key] = load()
+            elapsed = time.perf_counter() - start - (timings.get('decode', 0.0) - decoded)
+            timings['fetch'] = timings.get('fetch', 0.0) + elapsed
+        return self.lists[key]
+
+    def postings(self, term, idf=None):
+        return self.shared(('postings', term, idf), lambda: self.reader.postings(term, idf, self.timings))
+
+    def max_score(self, term, idf=None):
+        return self.shared(('max_score', term, idf), lambda: self.reader.max_score(term, idf))
+
+    def champions(self, term, idf=None):
+        return self.shared(('champions', term, idf), lambda: self.reader.champions(term, idf, self.timings))
@@ -1,158 +1,320 @@
 import os
+import hashlib
 import json
 import logging
-from collections import defaultdict
+import threading
+import time
+from multiprocessing import Pool
+import numpy as np
 from tokenizer import Tokenizer
-from utils import setup_logging, save_json
-from config import DATA_DIR, PARTIAL_INDEX_DIR, DOC_MAPPING_FILE, LOG_FILE, BATCH_SIZE, LINKS_FILE
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from utils import setup_logging
+from config import DATA_DIR, PARTIAL_INDEX_DIR, DOC_MAPPING_FILE, LOG_FILE, INDEX_BUFFER_BYTES, LINKS_FILE, NUM_WORKERS, SIMHASH_INDEX_FILE, METRICS_DIR, STEM_CACHE_BYTES
+from document import analyze_document, normalize_url
+from metrics import REGISTRY, SIZE_BUCKETS, add_time
+from near_duplicate import SimhashIndex
+from key_table import KeyTable
+from stores import DocStoreWriter, write_link_graph
+from partial_index import PostingsBuffer, write_run
+from urllib.parse import urlparse
 from simhash import Simhash
 
-def extract_outbound_links(content, base_url):
-    soup = BeautifulSoup(content, 'html.parser')
-    outbound_links = set()
+# Tokenizer owned by the current (worker) process, created by init_worker
+tokenizer = None
 
-    for a_tag in soup.find_all('a', href=True):
-        href = a_tag['href']
-        full_link = urljoin(base_url, href)
-        
-        parsed_link = urlparse(full_link)
-        if parsed_link.fragment:
+# Outbound links of the indexed documents, one [doc_id, urls] line each, until they are resolved
+LINKS_SPILL = 'links.jsonl'
+
+# Crawl files handed to the pool and not yet consumed, per worker. Pool.imap does not
+# wait for its consumer, so while a partial index is written the workers' results
+# would otherwise pile up in this process, outside the postings' memory budget.
+FILES_IN_FLIGHT_PER_WORKER = 64
+
+DOCUMENTS = REGISTRY.counter('indexer_documents_total', "Crawl files by outcome", ('outcome',))
+DOCUMENT_STAGE_SECONDS = REGISTRY.histogram('indexer_document_stage_seconds', "Time per document in each indexing stage", ('stage',))
+FLUSH_BYTES = REGISTRY.histogram('indexer_flush_bytes', "Size of the written partial indexes", buckets=SIZE_BUCKETS)
+BUFFER_BYTES = REGISTRY.histogram('indexer_buffer_bytes', "Estimated memory of the postings when they were flushed", buckets=SIZE_BUCKETS)
+FLUSH_SECONDS = REGISTRY.histogram('indexer_flush_seconds', "Time to write a partial index")
+LINK_RESOLVE_SECONDS = REGISTRY.gauge('indexer_link_resolve_seconds', "Time to resolve the outbound links to doc_ids and write the link graph")
+DOCUMENTS_PER_SECOND = REGISTRY.gauge('indexer_documents_per_second', "Indexed documents per second of the last run")
+STEM_LOOKUPS = REGISTRY.counter('indexer_stem_lookups_total', "Stem cache lookups of the tokenizers", ('result',))
+
+def init_worker(stem_cache_bytes=STEM_CACHE_BYTES):
+    global tokenizer
+    tokenizer = Tokenizer(stem_cache_bytes=stem_cache_bytes)
+
+def memory_budget(num_workers):
+    # (stem cache bytes of each tokenizer, postings bytes) out of INDEX_BUFFER_BYTES.
+    # Every worker keeps a stem cache, together they get at most a quarter of it.
+    stem_cache_bytes = min(STEM_CACHE_BYTES, INDEX_BUFFER_BYTES // (4 * num_workers))
+    return stem_cache_bytes, INDEX_BUFFER_BYTES - num_workers * stem_cache_bytes
+
+def process_file(file_path):
+    # Parse once, then hash, tokenize and extract links for one crawl file.
+    # Runs inside a pool worker, so it only returns data and never touches shared state:
+    # (file_path, parsed, error, seconds per stage, (stem cache hits, misses))
+    timings = {}
+    stems = tokenizer.stems
+    hits, misses = stems.hits, stems.misses
+    parsed, error = analyze_file(file_path, timings)
+    return file_path, parsed, error, timings, (stems.hits - hits, stems.misses - misses)
+
+def analyze_file(file_path, timings):
+    # (parsed, error) of one crawl file, both None for a skipped one
+    try:
+        start = time.perf_counter()
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            data = json.load(f)
+        url = data.get('url', '')
+        content = data.get('content', '')
+        start = add_time(timings, 'read', start)
+
+        parsed_url = urlparse(url)
+        if parsed_url.fragment:
+            return None, None
+
+        analysis = analyze_document(content, url, tokenizer, timings=timings)
+        start = time.perf_counter()
+        hash_value = Simhash(analysis.text.lower()).value
+        add_time(timings, 'simhash', start)
+        return (url, hash_value, analysis.tokens, analysis.outbound_links), None
+    except Exception as e:
+        return None, str(e)
+
+def record_document(outcome, timings):
+    DOCUMENTS.inc(outcome=outcome)
+    for stage, seconds in timings.items():
+        DOCUMENT_STAGE_SECONDS.observe(seconds, stage=stage)
+
+def print_stage_summary(elapsed):
+    # Totals of the document stages; the parsing ones are summed over all workers
+    indexed = DOCUMENTS.value(outcome='indexed')
+    print(f"{indexed} documents indexed in {elapsed:.1f} s ({indexed / elapsed if elapsed else 0:.1f} docs/sec)")
+    for (stage,), seconds in sorted(DOCUMENT_STAGE_SECONDS.sums().items()):
+        print(f"  {stage:>10}: {seconds:9.2f} s")
+    hits, misses = STEM_LOOKUPS.value(result='hit'), STEM_LOOKUPS.value(result='miss')
+    if hits + misses:
+        print(f"Stem cache: {hits / (hits + misses):.1%} of {hits + misses} lookups hit")
+
+def iter_domain_files(data_dir):
+    for entry in os.listdir(data_dir):
+        data_entry_path = os.path.join(data_dir, entry)
+        if not os.path.isdir(data_entry_path):
             continue
+        for data_folder in os.listdir(data_entry_path):
+            domain_path = os.path.join(data_entry_path, data_folder)
+            if os.path.isdir(domain_path):
+                files = [os.path.join(domain_path, file) for file in os.listdir(domain_path)]
+                yield data_folder, files
+
+def save_partial_index(postings, partial_count):
+    # Writes the buffered postings as a sorted run (see partial_index.py) the merger streams
+    print(f"\nSaving partial index {partial_count} ({len(postings)} terms, about {postings.nbytes / 2**20:.1f} MB in memory)...")
+    start = time.perf_counter()
+    partial_path = os.path.join(PARTIAL_INDEX_DIR, f'partial_{partial_count}.run')
+    size = write_run(postings.terms, partial_path)
+    FLUSH_SECONDS.observe(time.perf_counter() - start)
+    FLUSH_BYTES.observe(size)
+    BUFFER_BYTES.observe(postings.nbytes)
+    print(f"Saved {partial_path}")
+
+def remove_partial_indexes():
+    # Partials of an earlier run would otherwise be merged with this run's
+    for p_file in os.listdir(PARTIAL_INDEX_DIR):
+        if p_file.startswith('partial_') or p_file == LINKS_SPILL:
+            os.remove(os.path.join(PARTIAL_INDEX_DIR, p_file))
+
+def url_key(url):
+    # 64-bit hash standing in for a url in memory. The odds of any collision among a
+    # million urls are about 3 in 10^8.
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+class UrlIds:
+    # Normalized url -> doc_id of the indexed pages (the latest one added for the url),
+    # keyed by url_key so no url is kept. The keys and doc_ids sit in sorted columns,
+    # 12 bytes per url (see key_table.py).
+    def __init__(self):
+        self.doc_ids = KeyTable(np.uint32)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, url):
+        return bool(self.doc_ids.get(url_key(url)))
+
+    def __getitem__(self, url):
+        doc_ids = self.doc_ids.get(url_key(url))
+        if not doc_ids:
+            raise KeyError(url)
+        return doc_ids[-1]
+
+    def add(self, url, doc_id):
+        self.doc_ids.add(url_key(url), doc_id)
 
-        outbound_links.add(full_link)
+def bounded_imap(pool, function, items, limit, chunksize=1):
+    # pool.imap that hands out at most limit items whose results were not consumed yet.
+    # limit must exceed chunksize, or a chunk could wait for its own results.
+    slots = threading.Semaphore(limit)
+    done = threading.Event()
 
-    return list(outbound_links)
+    def feed():
+        # Runs in the pool's task handler thread
+        for item in items:
+            slots.acquire()
+            if done.is_set():
+                return
+            yield item
 
-def build_partial_indexes():
+    try:
+        for result in pool.imap(function, feed(), chunksize):
+            slots.release()
+            yield result
+    finally:
+        # Wakes the feeder if the consumer stopped early, so the pool can be joined
+        done.set()
+        slots.release()
+
+def read_links(path):
+    # (source doc_id, outbound urls) of the links spilled while indexing
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            source_doc_id, urls = json.loads(line)
+            yield source_doc_id, urls
+
+def resolve_links(links, url_to_doc_id):
+    # (source doc_id, normalized outbound URLs) pairs become (source doc_id, indexed doc_ids)
+    for source_doc_id, url_list in links:
+        yield source_doc_id, list({url_to_doc_id[u] for u in url_list if u in url_to_doc_id})
+
+def build_partial_indexes(num_workers=NUM_WORKERS):
     setup_logging(LOG_FILE)
-    tokenizer = Tokenizer()
-    inverted_index = defaultdict(list)  # token -> list of [doc_id, weight, [positions]]
-    doc_mapping = dict()
-    exsisting_url = set()
+    # Memory stays bounded: INDEX_BUFFER_BYTES is split between the workers' stem
+    # caches and the postings, which are flushed to a partial index when they reach
+    # their share (see memory_budget). The urls of the documents go to the doc
+    # store's temporary file and their outbound links to a spill file. What stays
+    # in memory per document are sorted array columns: the url hash and doc_id, the
+    # simhash fingerprint and its block tables and the doc store offset, about 80 bytes.
+    # The pool holds at most FILES_IN_FLIGHT_PER_WORKER unconsumed results per worker.
+    # Documents are deduplicated by normalized url, the form their links come in.
+    remove_partial_indexes()
+    stem_cache_bytes, postings_bytes = memory_budget(num_workers)
+    postings = PostingsBuffer()
+    doc_store = DocStoreWriter(DOC_MAPPING_FILE)
+    url_ids = UrlIds()
     doc_id = 1
     partial_count = 1
     total_docs = 0
-    exsisting_hash_values = []
-    duplicate_threshold = 1
+    simhash_index = SimhashIndex()
+
+    links_spill_path = os.path.join(PARTIAL_INDEX_DIR, LINKS_SPILL)
+    links_spill = open(links_spill_path, 'w', encoding='utf-8')
 
-    links_temp = defaultdict(list)
+    # Workers only parse; doc_ids, dedup and flushing stay here so that the
+    # output is identical to a single process run over the same files.
+    pool = None
+    if num_workers > 1:
+        pool = Pool(num_workers, initializer=init_worker, initargs=(stem_cache_bytes,))
+        in_flight = num_workers * FILES_IN_FLIGHT_PER_WORKER
+        results_for = lambda files: bounded_imap(pool, process_file, files, in_flight, chunksize=16)
+    else:
+        init_worker(stem_cache_bytes)
+        results_for = lambda files: map(process_file, files)
 
-    print("Starting indexing process...")
+    print(f"Starting indexing process with {num_workers} worker(s), {postings_bytes / 2**20:.0f} MB for postings "
+          f"and {stem_cache_bytes / 2**20:.0f} MB of stem cache per worker...")
+    start_time = time.perf_counter()
     try:
-        for entry in os.listdir(DATA_DIR):
-            data_entry_path = os.path.join(DATA_DIR, entry)
-            if not os.path.isdir(data_entry_path):
-                continue
-            for data_folder in os.listdir(data_entry_path):
-                domain_path = os.path.join(data_entry_path, data_folder)
-                if os.path.isdir(domain_path):
-                    print(f"\nProcessing domain: {data_folder}")
-                    domain_docs = 0
-                    
-                    for file in os.listdir(domain_path):
-                        file_path = os.path.join(domain_path, file)
-                        try:
-                            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                                data = json.load(f)
-                                url = data.get('url', '')
-                                content = data.get('content', '')
-
-
-                                if url in exsisting_url:
-                                    continue
-
-                                parsed_url = urlparse(url)
-                                if parsed_url.fragment:
-                                    continue
-
-                                # Checking for duplicates and near duplicate:
-                                sim_soup = BeautifulSoup(content, 'html.parser') 
-                                for tag in sim_soup(['script', 'style', 'header', 'footer', 'nav', 'aside', 'form', 'noscript']):
-                                    tag.decompose()
-                                text = ' '.join(sim_soup.stripped_strings)
-                                text = text.lower()
-                                hash_value = Simhash(text)
-                                duplicate_detected = False
-                                for hash in exsisting_hash_values:
-                                    if hash_value.distance(hash) <= duplicate_threshold:
-                                        duplicate_detected = True
-                                        break
-                                if duplicate_detected:
-                                    print("An similar file detected, skipping this one...")
-                                    continue
-                                exsisting_hash_values.append(hash_value)
-                                exsisting_url.add(url)
-                                doc_mapping[doc_id] = url
-
-                                weighted_tokens = tokenizer.tokenize_with_positions_and_weights(content)
-
-                                # weighted_tokens: token -> (total_weight, [positions])
-                                for token, (wfreq, positions) in weighted_tokens.items():
-                                    inverted_index[token].append([doc_id, wfreq, positions])
-
-                                outbound_links = extract_outbound_links(content, url)
-                                if outbound_links:
-                                    # Extend and deduplicate
-                                    links_temp[doc_id].extend(outbound_links)
-                                    links_temp[doc_id] = list(set(links_temp[doc_id]))
-
-                                doc_id += 1
-                                domain_docs += 1
-                                total_docs += 1
-
-                                if total_docs % 100 == 0:
-                                    print(f"Processed {total_docs} documents...")
-
-                            # Save partial indexes if batch size reached
-                            if (doc_id - 1) % BATCH_SIZE == 0:
-                                inverted_index = dict(sorted(inverted_index.items()))
-                                print(f"\nSaving partial index {partial_count} ({len(inverted_index)} terms)...")
-                                partial_path = os.path.join(PARTIAL_INDEX_DIR, f'partial_{partial_count}.json')
-                                save_json(inverted_index, partial_path)
-                                print(f"Saved {partial_path}")
-                                inverted_index = defaultdict(list)
-                                partial_count += 1
-
-                        except Exception as e:
-                            print(f"Error processing file {file_path}: {e}")
-                            logging.error(f"Error processing file {file_path}: {e}")
-                    
-                    print(f"Completed domain {data_folder}: processed {domain_docs} documents")
+        for data_folder, files in iter_domain_files(DATA_DIR):
+            print(f"\nProcessing domain: {data_folder}")
+            domain_docs = 0
+
+            for file_path, parsed, error, timings, (stem_hits, stem_misses) in results_for(files):
+                STEM_LOOKUPS.inc(stem_hits, result='hit')
+                STEM_LOOKUPS.inc(stem_misses, result='miss')
+                if error:
+                    print(f"Error processing file {file_path}: {error}")
+                    logging.error(f"Error processing file {file_path}: {error}")
+                    record_document('error', timings)
+                    continue
+                if parsed is None:
+                    record_document('skipped', timings)
+                    continue
+
+                url, hash_value, weighted_tokens, outbound_links = parsed
+                normalized_url = normalize_url(url)
+                if normalized_url in url_ids:
+                    record_document('duplicate', timings)
+                    continue
+
+                # Checking for duplicates and near duplicate:
+                start = time.perf_counter()
+                near_duplicate = simhash_index.query(hash_value) is not None
+                if near_duplicate:
+                    add_time(timings, 'dedup', start)
+                    record_document('near_duplicate', timings)
+                    print("An similar file detected, skipping this one...")
+                    continue
+                simhash_index.insert(hash_value)
+                url_ids.add(normalized_url, doc_id)
+                start = add_time(timings, 'dedup', start)
+                doc_store.add(doc_id, url)
+
+                # weighted_tokens: token -> (total_weight, [positions])
+                postings.add(doc_id, weighted_tokens)
+
+                if outbound_links:
+                    # Deduplicated
+                    links_spill.write(json.dumps([doc_id, list(set(outbound_links))]))
+                    links_spill.write('\n')
+                add_time(timings, 'postings', start)
+                record_document('indexed', timings)
+
+                doc_id += 1
+                domain_docs += 1
+                total_docs += 1
+
+                if total_docs % 100 == 0:
+                    print(f"Processed {total_docs} documents...")
+
+                # Save a partial index once the postings reach their memory budget
+                if postings.nbytes >= postings_bytes:
+                    save_partial_index(postings, partial_count)
+                    postings = PostingsBuffer()
+                    partial_count += 1
+
+            print(f"Completed domain {data_folder}: processed {domain_docs} documents")
 
         # Save any remaining documents
-        if inverted_index:
-            inverted_index = dict(sorted(inverted_index.items()))
-            print(f"\nSaving final partial index {partial_count}...")
-            partial_path = os.path.join(PARTIAL_INDEX_DIR, f'partial_{partial_count}.json')
-            save_json(inverted_index, partial_path)
-            print(f"Saved {partial_path}")
+        if len(postings):
+            save_partial_index(postings, partial_count)
+        postings = None  # freed before the links are resolved
 
         # Save document mapping
-        save_json(doc_mapping, DOC_MAPPING_FILE)
+        doc_store.finish()
+        simhash_index.save(SIMHASH_INDEX_FILE)
         print(f"Indexing complete! Processed {total_docs} documents in total")
 
-        # Resolve URLs in links_temp to doc_ids
-        url_to_doc_id = {v: k for k, v in doc_mapping.items()}
-        links_graph = {}
-        for source_doc_id, url_list in links_temp.items():
-            outbound_doc_ids = set()
-            for u in url_list:
-                parsed_out = urlparse(u)
-                if parsed_out.fragment:
-                    continue
-                if u in url_to_doc_id:
-                    outbound_doc_ids.add(url_to_doc_id[u])
-            links_graph[source_doc_id] = list(outbound_doc_ids)
-
+        # Resolve the spilled outbound URLs to doc_ids, streamed into the graph's arrays
         print(f"\nSaving links graph to {LINKS_FILE}...")
-        save_json(links_graph, LINKS_FILE)
+        start = time.perf_counter()
+        links_spill.close()
+        write_link_graph(resolve_links(read_links(links_spill_path), url_ids), LINKS_FILE)
+        os.remove(links_spill_path)
+        LINK_RESOLVE_SECONDS.set(time.perf_counter() - start)
+
+        elapsed = time.perf_counter() - start_time
+        DOCUMENTS_PER_SECOND.set(total_docs / elapsed if elapsed else 0.0)
+        print_stage_summary(elapsed)
+        REGISTRY.write(os.path.join(METRICS_DIR, 'indexer.prom'), prefix='indexer_')
 
     except Exception as e:
         print(f"Critical error: {e}")
         logging.critical(f"Critical error: {e}")
+    finally:
+        links_spill.close()
+        if pool:
+            pool.close()
+            pool.join()
 
 
 if __name__ == "__main__":
-    build_partial_indexes()
\ No newline at end of file
+    build_partial_indexes()
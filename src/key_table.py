@@ -0,0 +1,51 @@
+import numpy as np
+
+# uint64 key -> values, for the lookups the indexer makes once per document (urls,
+# simhash blocks). Entries live in sorted NumPy columns, recent inserts in a small
+# dict that is merged into them once it holds 1/BUFFER_FRACTION as many entries (at
+# least MIN_BUFFER). Memory stays close to the columns' bytes per entry, and since
+# the columns grow geometrically the merges cost O(1) amortized per insert.
+MIN_BUFFER = 4096
+BUFFER_FRACTION = 32
+
+
+class KeyTable:
+    def __init__(self, value_dtype=np.uint64):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.values = np.empty(0, dtype=value_dtype)
+        self.recent = {}  # key -> [values], not merged yet
+        self.recent_count = 0
+
+    def __len__(self):
+        return len(self.keys) + self.recent_count
+
+    def get(self, key):
+        # Values added under key, oldest first
+        values = []
+        search_key = np.uint64(key)
+        start = int(self.keys.searchsorted(search_key))
+        if start < len(self.keys) and self.keys[start] == search_key:
+            end = int(self.keys.searchsorted(search_key, 'right'))
+            values = self.values[start:end].tolist()
+        recent = self.recent.get(key)
+        return values + recent if recent else values
+
+    def add(self, key, value):
+        self.recent.setdefault(key, []).append(value)
+        self.recent_count += 1
+        if self.recent_count >= max(MIN_BUFFER, len(self.keys) // BUFFER_FRACTION):
+            self.merge()
+
+    def merge(self):
+        # Inserting after equal keys keeps the values of a key in insertion order
+        keys = np.fromiter((key for key, values in self.recent.items() for _ in values),
+                           dtype=np.uint64, count=self.recent_count)
+        values = np.fromiter((value for values in self.recent.values() for value in values),
+                             dtype=self.values.dtype, count=self.recent_count)
+        order = np.argsort(keys, kind='stable')
+        keys, values = keys[order], values[order]
+        positions = self.keys.searchsorted(keys, 'right')
+        self.keys = np.insert(self.keys, positions, keys)
+        self.values = np.insert(self.values, positions, values)
+        self.recent = {}
+        self.recent_count = 0
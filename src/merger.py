@@ -1,149 +1,202 @@
 import os
-import json
 import logging
-import math
-from collections import defaultdict
-from parse_file import processing_final_tokens
-from utils import setup_logging, save_json, load_json
+import shutil
+import time
+from multiprocessing import Pool
+from utils import setup_logging, save_json
+from stores import DocStore, PageRankStore
+from segments import SegmentWriter, publish, update_lock, index_directories, segment_path, shard_of, SEGMENT_POSTINGS, SEGMENT_POSITIONS, SEGMENT_TERMS, SEGMENT_DOCS
+from metrics import REGISTRY, add_time
+from partial_index import merged_postings, run_index
+from postings import compute_idf_value
 from config import (
-    PARTIAL_INDEX_DIR, 
-    FINAL_INDEX_DIR, 
-    LOG_FILE, 
-    DOC_MAPPING_FILE, 
-    IDF_FILE, 
-    DF_FILE  
+    PARTIAL_INDEX_DIR,
+    LOG_FILE,
+    DOC_MAPPING_FILE,
+    IDF_FILE,
+    DF_FILE,
+    PAGERANK_FILE,
+    METRICS_DIR,
+    NUM_WORKERS
 )
 
-def compute_idf(df_map, total_docs, idf_file):
-    idf = {}
-    for term, df in df_map.items():
-        if df > 0:
-            idf[term] = math.log10(total_docs / df)
-        else:
-            idf[term] = 0.0
-    save_json(idf, idf_file)
-    return idf
-
-def compute_tfidf(index_chunk, idf):
-    for token, postings in index_chunk.items():
-        term_idf = idf.get(token, 0.0)
-        for entry in postings:
-            doc_id = entry[0]
-            freq = entry[1]
-            positions = entry[2]
-            if freq > 0:
-                tf = 1 + math.log10(freq)
+BYTES_READ = REGISTRY.counter('merger_bytes_read_total', "Bytes read per merge phase", ('phase',))
+BYTES_WRITTEN = REGISTRY.counter('merger_bytes_written_total', "Bytes written per merge phase", ('phase',))
+PHASE_SECONDS = REGISTRY.counter('merger_phase_seconds_total', "Time spent in each merge phase", ('phase',))
+TERMS = REGISTRY.counter('merger_terms_total', "Terms written to the index")
+
+def partial_number(p_file):
+    # partial_10 has to come after partial_9 to keep postings in doc_id order
+    return int(p_file[len('partial_'):].split('.')[0])
+
+def term_ranges(partial_paths, count):
+    # Splits the terms into up to count ranges [low, high) holding about as many bytes
+    # of the partials each, so no worker gets all the frequent terms. Every entry of a
+    # partial's sparse index stands for the bytes up to the next one. Returns the
+    # ranges and, per range, the offset in each partial to read it from.
+    if count <= 1:
+        return [(None, None)], [[0] * len(partial_paths)]
+    indexes = [run_index(p_path) for p_path in partial_paths]
+    weights = []
+    for index, end in indexes:
+        ends = [offset for _, offset in index[1:]] + [end]
+        weights.extend((token, record_end - offset) for (token, offset), record_end in zip(index, ends))
+    weights.sort()
+    total = sum(weight for _, weight in weights)
+
+    bounds = []
+    cumulative = 0
+    for token, weight in weights:
+        if cumulative >= total * (len(bounds) + 1) / count and (not bounds or token > bounds[-1]):
+            bounds.append(token)
+        cumulative += weight
+    lows = [None] + bounds
+    ranges = list(zip(lows, bounds + [None]))
+
+    # The last indexed record of each partial below the range's low token is a safe
+    # start, since every record before it has a token at most as large
+    starts = []
+    for low in lows:
+        starts.append([max((offset for token, offset in index if low is not None and token < low), default=0)
+                       for index, _ in indexes])
+    return ranges, starts
+
+def merge_term_range(task):
+    # Merges the tokens of one range into a part per index directory.
+    # Returns the part of each directory, the range's df and its phase timings.
+    number, (low, high), starts, partial_paths, total_docs = task
+    pagerank_scores = PageRankStore(PAGERANK_FILE) if os.path.exists(PAGERANK_FILE) else None
+    writers = [SegmentWriter(directory, f"part_{number}.tmp") for directory in index_directories()]
+    df_map = {}
+    timings = {}
+    start = time.perf_counter()
+    try:
+        for token, postings in merged_postings(partial_paths, starts, low, high):
+            start = add_time(timings, 'merge', start)
+            df_map[token] = len(postings)
+            idf = compute_idf_value(df_map[token], total_docs)
+            if len(writers) == 1:
+                writers[0].add(token, postings, pagerank_scores, idf)
             else:
-                tf = 0
-            tfidf = tf * term_idf
-            entry[1] = tfidf  # Replace freq with tf-idf
-    return index_chunk
-
-def merge_partial_indexes():
+                shard_postings = [[] for _ in writers]
+                for posting in postings:
+                    shard_postings[shard_of(posting[0])].append(posting)
+                for writer, part in zip(writers, shard_postings):
+                    if part:
+                        writer.add(token, part, pagerank_scores, idf)
+            start = add_time(timings, 'write', start)
+    except Exception:
+        for writer in writers:
+            writer.discard()
+        raise
+    add_time(timings, 'merge', start)
+    return [writer.close() for writer in writers], df_map, timings
+
+def merge_partial_indexes(num_workers=NUM_WORKERS):
     setup_logging(LOG_FILE)
 
     if not os.path.exists(DOC_MAPPING_FILE):
         raise FileNotFoundError("Document mapping file not found. Cannot compute TF-IDF.")
-    with open(DOC_MAPPING_FILE, 'r') as f:
-        doc_mapping = json.load(f)
-    doc_mapping = {int(k): v for k, v in doc_mapping.items()}
-    total_docs = len(doc_mapping)
+    total_docs = len(DocStore(DOC_MAPPING_FILE))
     print(f"Total documents: {total_docs}")
 
-    partial_files = sorted(os.listdir(PARTIAL_INDEX_DIR))
-    total_files = len(partial_files)
-    
-
-    example_data = {}
-    for letter in range(ord('a'), ord('z') + 1):
-        filename = os.path.join(FINAL_INDEX_DIR, f"{chr(letter)}_tokens.json")
-        with open(filename, 'w') as json_file:
-            json.dump(example_data, json_file)
-    print("26 JSON files created from a_tokens.json to z_tokens.json.")
-
-    for digit in range(ord('0'), ord('9') + 1):
-        filename = os.path.join(FINAL_INDEX_DIR, f"{chr(digit)}_tokens.json")
-        with open(filename, 'w') as json_file:
-            json.dump(example_data, json_file)
-    print("10 JSON files created from 0_tokens.json to 9_tokens.json.")
-
-    df_map = defaultdict(int)
-    if os.path.exists(DF_FILE):
-        with open(DF_FILE, 'r') as df_file:
-            existing_df = json.load(df_file)
-            for term, df in existing_df.items():
-                df_map[term] += df
-
-    # Merge partial indexes incrementally
-    try:
-        for i, p_file in enumerate(partial_files, 1):
-            p_path = os.path.join(PARTIAL_INDEX_DIR, p_file)
-            try:
-                with open(p_path, 'r', encoding='utf-8') as pf:
-                    partial_index = json.load(pf)
-            except Exception as e:
-                print(f"Error loading {p_file}: {e}")
-                continue
-
-            tokens_by_letter = defaultdict(list)
-            for token, postings in partial_index.items():
-                first_char = token[0].lower()
-                tokens_by_letter[first_char].append((token, postings))
-                df_map[token] += len(postings)
-
-
-            for letter, tokens in tokens_by_letter.items():
-                final_index_file = os.path.join(FINAL_INDEX_DIR, f"{letter}_tokens.json")
-                try:
-                    with open(final_index_file, 'r') as ff:
-                        final_index = json.load(ff)
-                except Exception as e:
-                    print(f"Error loading final index file {final_index_file}: {e}")
-                    continue
-
-                for token, postings in tokens:
-                    if token in final_index:
-                        final_index[token].extend(postings)
-                    else:
-                        final_index[token] = postings
-
-                sorted_final_index = dict(sorted(final_index.items()))
-                save_json(sorted_final_index, final_index_file)
-
-
-            print(f"Successfully merged {p_file}")
-
-
-        save_json(df_map, DF_FILE)
-        print(f"DF values saved to {DF_FILE}")
-
-        idf = compute_idf(df_map, total_docs, IDF_FILE)
-        print(f"IDF values computed and saved to {IDF_FILE}")
-
-        # Compute TF-IDF for each final index file
-        for final_file in [f for f in os.listdir(FINAL_INDEX_DIR) if f.endswith('_tokens.json')]:
-            final_path = os.path.join(FINAL_INDEX_DIR, final_file)
-            try:
-                with open(final_path, 'r') as f_final:
-                    index_data = json.load(f_final)
-
-                index_data = compute_tfidf(index_data, idf)
-
-                sorted_index_data = dict(sorted(index_data.items()))
-                save_json(sorted_index_data, final_path)
-                print(f"TF-IDF scores computed and updated in {final_file}")
-            except Exception as e:
-                print(f"Error processing final index file {final_path}: {e}")
-                continue
+    # PageRank only orders the champion tiers, so the merge also works without it.
+    # Each range worker opens the store itself.
+    if not os.path.exists(PAGERANK_FILE):
+        print(f"{PAGERANK_FILE} not found, champion tiers are ordered by tf-idf only")
 
-        print("Merge and TF-IDF computation completed successfully!")
+    partial_files = sorted((f for f in os.listdir(PARTIAL_INDEX_DIR) if f.endswith('.run')), key=partial_number)
+    partial_paths = [os.path.join(PARTIAL_INDEX_DIR, p_file) for p_file in partial_files]
+    print(f"Merging {len(partial_paths)} partial indexes...")
 
-        # Convert the file and data structures of the final index files for quicker retrieval
-        print("Staring converting indexes from json to txt")
-        processing_final_tokens()
+    # df is recomputed from the partials on every run
+    df_map = {}
+    idf = {}
+
+    # The whole crawl becomes one segment, or one per shard with each shard getting the
+    # documents of its doc_id % NUM_SHARDS. The terms are split into num_workers ranges
+    # of similar size that are merged and written in parallel, each into parts of its
+    # own, which are then appended in term order. Only the postings of the current term
+    # of each range are held in memory while they are written.
+    # Phases: merge (reading and merging the partials), write (encoding and writing
+    # postings), both summed over the workers, finish (appending the parts, term tables
+    # and doc stores) and publish.
+    timings = {}
+    directories = index_directories()
+    writers = []
+    tasks = []
+    try:
+        writers = [SegmentWriter(directory) for directory in directories]
+        BYTES_READ.inc(sum(os.path.getsize(p_path) for p_path in partial_paths), phase='merge')
+        ranges, starts = term_ranges(partial_paths, num_workers)
+        tasks = [(number, term_range, range_starts, partial_paths, total_docs)
+                 for number, (term_range, range_starts) in enumerate(zip(ranges, starts))]
+        print(f"Merging {len(tasks)} term range(s) with {num_workers} worker(s)...")
+        merge_start = time.perf_counter()
+        if num_workers > 1:
+            with Pool(num_workers) as pool:
+                results = pool.map(merge_term_range, tasks, chunksize=1)
+        else:
+            results = [merge_term_range(task) for task in tasks]
+        print(f"Term ranges merged in {time.perf_counter() - merge_start:.2f} s")
+
+        start = time.perf_counter()
+        for parts, range_df, range_timings in results:
+            for writer, (part_directory, offset_map) in zip(writers, parts):
+                writer.append(part_directory, offset_map)
+            for token, df in range_df.items():
+                df_map[token] = df
+                idf[token] = compute_idf_value(df, total_docs)
+            TERMS.inc(len(range_df))
+            for phase, seconds in range_timings.items():
+                timings[phase] = timings.get(phase, 0.0) + seconds
+        add_time(timings, 'finish', start)
+
+        start = time.perf_counter()
+        if len(writers) == 1:
+            segment_directories = [writers[0].finish(doc_store_path=DOC_MAPPING_FILE)]
+        else:
+            shard_docs = [dict() for _ in writers]
+            for doc_id, url in DocStore(DOC_MAPPING_FILE).items():
+                shard_docs[shard_of(doc_id)][doc_id] = url
+            segment_directories = [writer.finish(doc_mapping) for writer, doc_mapping in zip(writers, shard_docs)]
+        add_time(timings, 'finish', start)
+        for segment_directory in segment_directories:
+            BYTES_WRITTEN.inc(os.path.getsize(os.path.join(segment_directory, SEGMENT_POSTINGS))
+                              + os.path.getsize(os.path.join(segment_directory, SEGMENT_POSITIONS)), phase='write')
+            BYTES_WRITTEN.inc(os.path.getsize(os.path.join(segment_directory, SEGMENT_TERMS))
+                              + os.path.getsize(os.path.join(segment_directory, SEGMENT_DOCS)), phase='finish')
+
+        with update_lock():
+            save_json(df_map, DF_FILE)
+            print(f"DF values saved to {DF_FILE}")
+            save_json(idf, IDF_FILE)
+            print(f"IDF values computed and saved to {IDF_FILE}")
+
+            # The new segment holds the whole crawl (or shard) and replaces every earlier one
+            start = time.perf_counter()
+            for directory, segment_directory in zip(directories, segment_directories):
+                manifest = publish(lambda manifest, new_name: [new_name], segment_directory, lambda tombstones: [], directory)
+                print(f"Published {manifest['segments'][0]} in {directory} as index generation {manifest['generation']}")
+            add_time(timings, 'publish', start)
+
+        for phase, seconds in timings.items():
+            PHASE_SECONDS.inc(seconds, phase=phase)
+            print(f"  {phase:>8}: {seconds:8.2f} s, read {BYTES_READ.value(phase=phase) / 1024:10.1f} KB, "
+                  f"wrote {BYTES_WRITTEN.value(phase=phase) / 1024:10.1f} KB")
+        REGISTRY.write(os.path.join(METRICS_DIR, 'merger.prom'), prefix='merger_')
+        print("Merge and TF-IDF computation completed successfully!")
 
     except Exception as e:
         print(f"Critical error occurred: {e}")
+        logging.critical(f"Critical error occurred: {e}")
+        # Working directories of the failed merge, with the parts of the ranges that
+        # finished but were not appended yet
+        for writer in writers:
+            writer.discard()
+        for directory in directories:
+            for number in range(len(tasks)):
+                shutil.rmtree(segment_path(f"part_{number}.tmp", directory), ignore_errors=True)
 
 if __name__ == "__main__":
     merge_partial_indexes()
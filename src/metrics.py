@@ -0,0 +1,180 @@
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Counters, gauges and histograms of the indexing and search pipelines, rendered in
+# the Prometheus text format. The web app serves them at /metrics, the build scripts
+# write them to METRICS_DIR/<script>.prom when they finish (the layout the node
+# exporter's textfile collector reads).
+# Every process has its own registry, so pre-forked web workers report separately.
+
+# Seconds, from a cached lookup to a slow build phase
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Bytes, for file and flush sizes
+SIZE_BUCKETS = tuple(4 ** exponent * 1024 for exponent in range(13))
+
+
+def label_text(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    # Incremented directly, or read from function at render time for a total that is
+    # kept elsewhere and only ever grows
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> total
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        if self.function:
+            return lines + [f"{self.name} {self.function()}"]
+        with self.lock:
+            for key, total in sorted(self.values.items()):
+                lines.append(f"{self.name}{label_text(self.labelnames, key)} {total}")
+        return lines
+
+
+class Gauge:
+    # Set directly, or read from function at render time
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def render(self):
+        value = self.function() if self.function else self.current
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> [count per bucket (not cumulative)..., count above the last, count, sum]
+        self.series = {}
+
+    def observe(self, value, **labels):
+        # Search observes several stages per query, so this stays O(log buckets)
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 3)
+            series[bucket] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def sums(self):
+        # label values -> sum of the observed values
+        with self.lock:
+            return {key: series[-1] for key, series in self.series.items()}
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{label_text(self.labelnames, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{label_text(self.labelnames, key, [('le', '+Inf')])} {series[-2]}")
+                lines.append(f"{self.name}_count{label_text(self.labelnames, key)} {series[-2]}")
+                lines.append(f"{self.name}_sum{label_text(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        # Modules are imported once per process, but a metric asked for twice is shared
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        counter = self.register(Counter(name, documentation, labelnames))
+        counter.function = function or counter.function
+        return counter
+
+    def gauge(self, name, documentation, function=None):
+        gauge = self.register(Gauge(name, documentation))
+        gauge.function = function or gauge.function
+        return gauge
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self, prefix=''):
+        with self.lock:
+            metrics = [metric for name, metric in sorted(self.metrics.items()) if name.startswith(prefix)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filepath, prefix=''):
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        temp_path = filepath + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render(prefix))
+        os.replace(temp_path, filepath)
+
+
+REGISTRY = Registry()
+
+
+def add_time(timings, stage, start):
+    # Adds the seconds since start to timings[stage], returns the current time
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
+
+def profile_call(function, *args, top=25, **kwargs):
+    # (result, cProfile report of the top functions by cumulative time) of one call
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(top)
+    return result, report.getvalue()
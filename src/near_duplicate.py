@@ -0,0 +1,59 @@
+import os
+from array import array
+from config import DUPLICATE_THRESHOLD
+from key_table import KeyTable
+
+class SimhashIndex:
+    # Finds fingerprints within `threshold` bits of a query without scanning them all.
+    # The fingerprint is cut into threshold + 1 blocks. Two fingerprints that differ in
+    # at most `threshold` bits must agree exactly on at least one block, so only the
+    # fingerprints sharing a block with the query are compared. Each block's table maps
+    # the block to the fingerprints with it, in sorted uint64 columns (see key_table.py).
+    def __init__(self, threshold=DUPLICATE_THRESHOLD, bits=64):
+        self.threshold = threshold
+        self.bits = bits
+        self.fingerprints = array('Q')
+
+        num_blocks = threshold + 1
+        self.blocks = []
+        start = 0
+        for i in range(num_blocks):
+            width = bits // num_blocks + (1 if i < bits % num_blocks else 0)
+            self.blocks.append((start, (1 << width) - 1))
+            start += width
+        self.tables = [KeyTable() for _ in self.blocks]
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def distance(self, a, b):
+        return bin((a ^ b) & ((1 << self.bits) - 1)).count('1')
+
+    def query(self, value):
+        # Returns a stored fingerprint within the threshold, or None
+        for table, (shift, mask) in zip(self.tables, self.blocks):
+            for candidate in table.get((value >> shift) & mask):
+                if self.distance(value, candidate) <= self.threshold:
+                    return candidate
+        return None
+
+    def insert(self, value):
+        self.fingerprints.append(value)
+        for table, (shift, mask) in zip(self.tables, self.blocks):
+            table.add((value >> shift) & mask, value)
+
+    def save(self, filepath):
+        with open(filepath, 'wb') as f:
+            self.fingerprints.tofile(f)
+
+    @classmethod
+    def load(cls, filepath, threshold=DUPLICATE_THRESHOLD, bits=64):
+        index = cls(threshold, bits)
+        if not os.path.exists(filepath):
+            return index
+        fingerprints = array('Q')
+        with open(filepath, 'rb') as f:
+            fingerprints.frombytes(f.read())
+        for value in fingerprints:
+            index.insert(value)
+        return index
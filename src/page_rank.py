@@ -1,6 +1,8 @@
-import json
 import os
+import numpy as np
 from config import LINKS_FILE, DOC_MAPPING_FILE, PAGERANK_FILE
+from segments import open_index, index_directories, index_docs
+from stores import DocStore, LinkGraph, write_pagerank_store
 
 def compute_pagerank(links_graph, damping=0.85, max_iterations=100, tolerance=1.0e-6):
     doc_ids = list(links_graph.keys())
@@ -37,30 +39,67 @@ def compute_pagerank(links_graph, damping=0.85, max_iterations=100, tolerance=1.
 
     return pr_values
 
-def main():
-    
-    if not os.path.exists(LINKS_FILE):
-        raise FileNotFoundError(f"{LINKS_FILE} not found.")
+def links_to_csr(links_graph):
+    # Compact adjacency: node i links to targets[offsets[i]:offsets[i + 1]]
+    doc_ids = list(links_graph.keys())
+    node_of = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+    out_degree = np.array([len(links_graph[doc_id]) for doc_id in doc_ids], dtype=np.int64)
+    offsets = np.zeros(len(doc_ids) + 1, dtype=np.int64)
+    np.cumsum(out_degree, out=offsets[1:])
+    targets = np.fromiter((node_of[t] for doc_id in doc_ids for t in links_graph[doc_id]),
+                          dtype=np.int32, count=int(offsets[-1]))
+    return doc_ids, offsets, targets
+
+def compute_pagerank_csr(offsets, targets, damping=0.85, max_iterations=100, tolerance=1.0e-6):
+    # Same iteration as compute_pagerank, one sparse matrix-vector product per step
+    n = len(offsets) - 1
+    if n == 0:
+        return np.zeros(0)
 
-    with open(LINKS_FILE, 'r', encoding='utf-8') as f:
-        links_graph = json.load(f)
+    out_degree = np.diff(offsets)
+    sources = np.repeat(np.arange(n), out_degree)
+    dangling = out_degree == 0
+    # Share of a source's rank passed along each of its edges
+    edge_weight = 1.0 / out_degree[sources]
 
-    links_graph = {int(k): [int(x) for x in v] for k, v in links_graph.items()}
+    pr_values = np.full(n, 1.0 / n)
+    for iteration in range(max_iterations):
+        dangling_sum = pr_values[dangling].sum()
+        inbound = np.bincount(targets, weights=pr_values[sources] * edge_weight, minlength=n)
+        new_pr = (1 - damping) / n + damping * (dangling_sum / n) + damping * inbound
 
-    # Remove self-links
-    for doc_id in list(links_graph.keys()):
-        links_graph[doc_id] = [x for x in links_graph[doc_id] if x != doc_id]
+        diff = np.abs(new_pr - pr_values).sum()
+        pr_values = new_pr
+        if diff < tolerance:
+            break
 
+    return pr_values
 
-    all_targets = {t for targets in links_graph.values() for t in targets}
-    for t in all_targets:
-        if t not in links_graph:
-            links_graph[t] = []
+def compute_pagerank_sparse(links_graph, damping=0.85, max_iterations=100, tolerance=1.0e-6):
+    doc_ids, offsets, targets = links_to_csr(links_graph)
+    pr_values = compute_pagerank_csr(offsets, targets, damping, max_iterations, tolerance)
+    return dict(zip(doc_ids, pr_values.tolist()))
+
+def save_pagerank(slots=0, links_path=LINKS_FILE, pagerank_path=PAGERANK_FILE):
+    # The link graph's CSR arrays are used straight from the mapped file
+    graph = LinkGraph(links_path)
+    doc_ids, offsets, targets = graph.arrays()
+    pr_values = compute_pagerank_csr(offsets.astype(np.int64), targets)
+    pagerank_scores = dict(zip(doc_ids.tolist(), pr_values.tolist()))
+    graph.close()
+
+    # Cover every doc_id, including documents that are not part of the link graph
+    indexed = index_docs([open_index(directory)[1] for directory in index_directories()])
+    slots = max(slots, max(pagerank_scores, default=-1) + 1, indexed.slots)
+    if os.path.exists(DOC_MAPPING_FILE):
+        slots = max(slots, DocStore(DOC_MAPPING_FILE).slots)
+    write_pagerank_store(pagerank_scores, slots, pagerank_path)
 
-    pagerank_scores = compute_pagerank(links_graph)
+def main():
+    if not os.path.exists(LINKS_FILE):
+        raise FileNotFoundError(f"{LINKS_FILE} not found.")
 
-    with open(PAGERANK_FILE, 'w', encoding='utf-8') as f:
-        json.dump(pagerank_scores, f, indent=2)
+    save_pagerank()
 
 if __name__ == "__main__":
     main()
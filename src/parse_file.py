@@ -1,70 +1,42 @@
-import json
-from config import FINAL_INDEX_DIR, TOKEN_RETRIEVAL_OFFSET_FILE
-import os
+from config import CHAMPION_LIST_SIZE
+import numpy as np
+from postings import encode_postings, decode_postings, tfidf_value
 
 
-def tokens_load_for_read(json_file):
-    with open(json_file, 'r') as file:
-        data = json.load(file)
+def write_encoded(file, positions_file, postings):
+    # Appends one postings block and its positions, returns the block's offset and length
+    position = file.tell()
+    data, positions = encode_postings(postings, positions_file.tell())
+    file.write(data)
+    positions_file.write(positions)
+    return position, len(data)
 
-    output_file = json_file[:-4] + "txt"
-    with open(output_file, 'w') as file:
-        for term, postings in data.items():
-            file.write(f"${term}$\n")
-            for posting in postings:
-                positions = ""
-                for position in posting[2]:
-                    positions += f" {position}"
-                write_in = f"{posting[0]},{posting[1]},{positions}"
-                file.write(f"{write_in}\n")
 
+def write_token_postings(file, positions_file, term, postings, pagerank_scores=None, idf=1.0):
+    # Appends the binary postings of one term, with their positions going to
+    # positions_file, and returns its offset table entry:
+    #   [offset, byte length, max weight, df]
+    # and, for terms with more than CHAMPION_LIST_SIZE postings, a first tier of the
+    # highest impact (tf-idf plus PageRank) postings written right after them:
+    #   [..., champion offset, champion byte length, max weight outside the champions]
+    # Postings hold weights, not tf-idf, so idf only orders the champions here and is
+    # applied at query time with the df of all segments.
+    position, length = write_encoded(file, positions_file, postings)
+    max_weight = float(np.float32(max(posting[1] for posting in postings)))
+    entry = [position, length, max_weight, len(postings)]
 
-def track_token_retreival_offset(text_file, token_retrieval_offset_map):
-    token = None
-    posting_len = 0
-    position = None
-    with open(text_file, 'r') as file:
-        while True:
-            line = file.readline()
-            if not line:
-                break
-            if line.startswith('$') and line.endswith('$\n'):
-                if token:
-                    token_retrieval_offset_map[token] = [position, posting_len]
-                token = line[1:-2]
-                position = file.tell()
-                posting_len = 0
-            else:
-                posting_len += 1
-    if not token:
-        token_retrieval_offset_map[token] = [position, posting_len]
+    if CHAMPION_LIST_SIZE and len(postings) > CHAMPION_LIST_SIZE:
+        pagerank_of = pagerank_scores.get if pagerank_scores else (lambda doc_id: 0.0)
+        by_impact = sorted(postings, key=lambda p: (-(tfidf_value(p[1], idf) + pagerank_of(p[0])), p[0]))
+        champions = sorted(by_impact[:CHAMPION_LIST_SIZE], key=lambda p: p[0])
+        tail_max_weight = float(np.float32(max(posting[1] for posting in by_impact[CHAMPION_LIST_SIZE:])))
+        champion_position, champion_length = write_encoded(file, positions_file, champions)
+        entry += [champion_position, champion_length, tail_max_weight]
+    return entry
 
-def load_token_data(file, location_info):
-    file.seek(location_info[0])
-    length = location_info[1]
-    data_fetched = []
-    count = 0
-    while count < length:
-        count += 1
-        line = file.readline()
-        parts = line.split(",")
-        id = int(parts[0])
-        score = float(parts[1])
-        numbers = list(map(int, parts[2].strip().split()))
-        data_fetched.append([id, score, numbers])
-    file.seek(0)
-    return data_fetched
 
-def processing_final_tokens():
-    token_retrieval_offset_map = {}
-    for letter in range(ord('a'), ord('z') + 1):
-        tokens_load_for_read(f'{FINAL_INDEX_DIR}/{chr(letter)}_tokens.json')
-        track_token_retreival_offset(f'{FINAL_INDEX_DIR}/{chr(letter)}_tokens.txt', token_retrieval_offset_map)
-        print(f"Finish processing {FINAL_INDEX_DIR}/{chr(letter)}_tokens.json")
-    for letter in range(ord('0'), ord('9') + 1):
-        tokens_load_for_read(f'{FINAL_INDEX_DIR}/{chr(letter)}_tokens.json')
-        track_token_retreival_offset(f'{FINAL_INDEX_DIR}/{chr(letter)}_tokens.txt', token_retrieval_offset_map)
-        print(f"Finish processing {FINAL_INDEX_DIR}/{chr(letter)}_tokens.json")
-    with open(TOKEN_RETRIEVAL_OFFSET_FILE, 'w') as file:
-        json.dump(token_retrieval_offset_map, file)
-        print("Finish writing token retrieval offset file")
+def load_token_data(buffer, positions_buffer, location_info):
+    # buffer and positions_buffer are the whole posting and positions files (e.g.
+    # memoryviews over their mmaps), so slicing copies nothing
+    offset, length = location_info[0], location_info[1]
+    return decode_postings(buffer[offset:offset + length], positions_buffer)
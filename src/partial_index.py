@@ -0,0 +1,123 @@
+import heapq
+import struct
+from array import array
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
+
+# The postings the indexer holds between two flushes, and the partial indexes it
+# flushes them to: sorted runs that the merger streams and splits into term ranges.
+# A run is a sequence of records in token order,
+#   RUN_RECORD, token, doc_ids (uint32), weights (float64), position counts (uint32), positions (uint32)
+# followed by a sparse index of (record offset, token) of one record every
+# RUN_INDEX_INTERVAL bytes and the RUN_TRAILER.
+
+RUN_RECORD = struct.Struct('<III')  # token bytes, postings, positions
+RUN_INDEX_ENTRY = struct.Struct('<QI')  # record offset, token bytes
+RUN_TRAILER = struct.Struct('<QQ')  # index offset, index entries
+RUN_INDEX_INTERVAL = 16 * 1024  # Bytes of records between two index entries
+# Estimated bytes of a new term in the buffer: its dict slot, key and four arrays
+TERM_OVERHEAD = 480
+# Weights keep the tokenizer's doubles, the merger rounds them to float32 itself
+RUN_ARRAYS = ('<u4', '<f8', '<u4', '<u4')
+
+
+class PostingsBuffer:
+    # token -> (doc_ids, weights, position counts, positions) arrays, appended to in
+    # doc_id order. nbytes estimates their memory, so the indexer can flush on a budget.
+    def __init__(self):
+        self.terms = {}
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.terms)
+
+    def add(self, doc_id, weighted_tokens):
+        # weighted_tokens: token -> (total weight, [positions]) of one document
+        for token, (weight, positions) in weighted_tokens.items():
+            arrays = self.terms.get(token)
+            if arrays is None:
+                arrays = self.terms[token] = (array('I'), array('d'), array('I'), array('I'))
+                self.nbytes += TERM_OVERHEAD + len(token)
+            doc_ids, weights, counts, all_positions = arrays
+            doc_ids.append(doc_id)
+            weights.append(weight)
+            counts.append(len(positions))
+            all_positions.extend(positions)
+            self.nbytes += 16 + 4 * len(positions)
+
+
+def write_run(terms, path):
+    # terms: a PostingsBuffer's token -> arrays. Returns the number of bytes written.
+    index = []
+    next_indexed = 0
+    with open(path, 'wb') as f:
+        for token in sorted(terms):
+            offset = f.tell()
+            encoded = token.encode('utf-8')
+            if offset >= next_indexed:
+                index.append((offset, encoded))
+                next_indexed = offset + RUN_INDEX_INTERVAL
+            arrays = terms[token]
+            f.write(RUN_RECORD.pack(len(encoded), len(arrays[0]), len(arrays[3])))
+            f.write(encoded)
+            for values, dtype in zip(arrays, RUN_ARRAYS):
+                f.write(np.asarray(values).astype(dtype, copy=False).tobytes())
+        index_offset = f.tell()
+        for offset, encoded in index:
+            f.write(RUN_INDEX_ENTRY.pack(offset, len(encoded)))
+            f.write(encoded)
+        f.write(RUN_TRAILER.pack(index_offset, len(index)))
+        return f.tell()
+
+
+def run_index(path):
+    # ([(token, record offset)] of the sparse index, offset where the records end)
+    with open(path, 'rb') as f:
+        f.seek(-RUN_TRAILER.size, 2)
+        index_offset, entries = RUN_TRAILER.unpack(f.read(RUN_TRAILER.size))
+        f.seek(index_offset)
+        index = []
+        for _ in range(entries):
+            offset, token_length = RUN_INDEX_ENTRY.unpack(f.read(RUN_INDEX_ENTRY.size))
+            index.append((f.read(token_length).decode('utf-8'), offset))
+    return index, index_offset
+
+
+def read_run(path, start=0, low=None, high=None):
+    # Yields (token, [[doc_id, weight, [positions]], ...]) in token order for the tokens
+    # in [low, high), reading from the record at byte offset start on. Postings of
+    # tokens outside the range are skipped without being read.
+    _, end = run_index(path)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            token_length, count, position_count = RUN_RECORD.unpack(f.read(RUN_RECORD.size))
+            token = f.read(token_length).decode('utf-8')
+            size = 16 * count + 4 * position_count
+            offset += RUN_RECORD.size + token_length + size
+            if high is not None and token >= high:
+                return
+            if low is not None and token < low:
+                f.seek(size, 1)
+                continue
+            doc_ids = np.frombuffer(f.read(4 * count), dtype='<u4').tolist()
+            weights = np.frombuffer(f.read(8 * count), dtype='<f8').tolist()
+            counts = np.frombuffer(f.read(4 * count), dtype='<u4')
+            positions = np.frombuffer(f.read(4 * position_count), dtype='<u4').tolist()
+            ends = np.cumsum(counts).tolist()
+            starts = [0] + ends[:-1]
+            yield token, [[doc_id, weight, positions[s:e]] for doc_id, weight, s, e in zip(doc_ids, weights, starts, ends)]
+
+
+def merged_postings(run_paths, starts=None, low=None, high=None):
+    # k-way merge of sorted runs written in doc_id order. heapq.merge is stable, so
+    # postings of a token shared by several runs are concatenated in run (= doc_id) order.
+    starts = starts or [0] * len(run_paths)
+    streams = [read_run(run_path, start, low, high) for run_path, start in zip(run_paths, starts)]
+    for token, group in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+        postings = []
+        for _, run_postings in group:
+            postings.extend(run_postings)
+        yield token, postings
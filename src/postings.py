@@ -0,0 +1,281 @@
+import math
+import operator
+import struct
+from bisect import bisect_right
+from itertools import accumulate
+import numpy as np
+
+# Binary layout of one term's postings:
+#   header       count, doc_id bytes, positions offset, run length bytes (uint32, uint32, uint64, uint32)
+#   doc_ids      varints, first doc_id then gaps
+#   weights      float32 per posting, the field weighted term frequency
+# The positions are kept apart, in a positions stream, at the header's positions offset:
+#   run lengths  varints, byte length of each posting's run
+#   runs         varints, per posting the first position then gaps
+# Only the proximity bonus reads positions, and only for documents that have every
+# query term, so they are decoded a posting at a time when it asks for them.
+HEADER = struct.Struct('<IIQI')
+# Shorter lists are encoded in pure Python: numpy's fixed cost per call is far higher
+# than the loop for a few values, and most terms have only a few postings.
+SMALL_VARINTS = 256
+SMALL_POSTINGS = 128
+
+
+def append_varints(out, values):
+    # Appends the varints of values (ints >= 0) to the bytearray out
+    for value in values:
+        while value > 0x7f:
+            out.append(value & 0x7f | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def encode_varints(values):
+    if len(values) < SMALL_VARINTS:
+        out = bytearray()
+        append_varints(out, values.tolist() if isinstance(values, np.ndarray) else values)
+        return bytes(out)
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(nbytes) - nbytes
+    group = np.repeat(np.arange(len(values)), nbytes)
+    byte_index = np.arange(nbytes.sum()) - np.repeat(starts, nbytes)
+    out = (values[group] >> (7 * byte_index).astype(np.uint64)) & np.uint64(0x7f)
+    out |= (byte_index < nbytes[group] - 1).astype(np.uint64) << np.uint64(7)
+    return out.astype(np.uint8).tobytes()
+
+
+def decode_varints(buf):
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = (np.arange(len(data)) - np.repeat(starts, ends - starts + 1)) * 7
+    return np.add.reduceat((data & 0x7f).astype(np.int64) << shifts, starts)
+
+
+def compute_idf_value(df, total_docs):
+    if df > 0:
+        return math.log10(total_docs / df)
+    return 0.0
+
+
+def tfidf_value(weight, idf):
+    if weight > 0:
+        return (1 + math.log10(weight)) * idf
+    return 0.0
+
+
+def weights_to_tfidf(weights, idf):
+    # float32 tf-idf of stored weights. Weights are sums of field weights (multiples of
+    # 0.5) and so exact in float32, and a page has few distinct ones, so each distinct
+    # weight is scored once with tfidf_value.
+    values, inverse = np.unique(weights, return_inverse=True)
+    scores = np.array([tfidf_value(weight, idf) for weight in values.tolist()], dtype='<f4')
+    return scores[inverse]
+
+
+def encode_postings(postings, positions_offset=0):
+    # postings: [[doc_id, weight, [positions]], ...] sorted by doc_id.
+    # Returns the postings block and the positions block, which the caller writes at
+    # positions_offset of the positions stream.
+    if len(postings) < SMALL_POSTINGS:
+        return encode_short_postings(postings, positions_offset)
+    doc_ids = np.array([p[0] for p in postings], dtype=np.int64)
+    scores = np.array([p[1] for p in postings], dtype='<f4')
+    counts = np.array([len(p[2]) for p in postings], dtype=np.int64)
+    positions = np.array([pos for p in postings for pos in p[2]], dtype=np.int64)
+
+    doc_gaps = np.diff(doc_ids, prepend=0)
+    position_gaps = np.diff(positions, prepend=0)
+    # The first position of every posting is stored as is, not as a gap
+    first = np.cumsum(counts) - counts
+    position_gaps[first[counts > 0]] = positions[first[counts > 0]]
+
+    doc_bytes = encode_varints(doc_gaps)
+    run_bytes = encode_varints(position_gaps)
+    # Byte length of each posting's run: the varints that end (high bit clear) in it
+    ends = np.flatnonzero(np.frombuffer(run_bytes, dtype=np.uint8) < 0x80) + 1
+    run_ends = np.zeros(len(postings) + 1, dtype=np.int64)
+    run_ends[1:][counts > 0] = ends[np.cumsum(counts)[counts > 0] - 1]
+    run_ends = np.maximum.accumulate(run_ends)
+    length_bytes = encode_varints(np.diff(run_ends))
+    header = HEADER.pack(len(postings), len(doc_bytes), positions_offset, len(length_bytes))
+    return b''.join([header, doc_bytes, scores.tobytes()]), length_bytes + run_bytes
+
+
+def encode_short_postings(postings, positions_offset):
+    # encode_postings in pure Python, same bytes
+    doc_ids = [p[0] for p in postings]
+    doc_bytes = bytearray()
+    append_varints(doc_bytes, map(operator.sub, doc_ids, [0] + doc_ids[:-1]))
+    runs = bytearray()
+    run_lengths = []
+    for posting in postings:
+        positions = posting[2]
+        start = len(runs)
+        append_varints(runs, map(operator.sub, positions, [0] + positions[:-1]))
+        run_lengths.append(len(runs) - start)
+    length_bytes = encode_varints(run_lengths)
+    scores = struct.pack(f'<{len(postings)}f', *[p[1] for p in postings])
+    header = HEADER.pack(len(postings), len(doc_bytes), positions_offset, len(length_bytes))
+    return b''.join([header, doc_bytes, scores]), length_bytes + bytes(runs)
+
+
+def decode_run(data):
+    # Positions of one posting from its run of varints (bytes)
+    if data.isascii():
+        # Every gap fits in one byte
+        return list(accumulate(data))
+    positions = []
+    position = value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            position += value
+            positions.append(position)
+            value = shift = 0
+    return positions
+
+
+class PositionRuns:
+    # The positions block of one encoded list. The run lengths are decoded the first
+    # time a posting's positions are asked for, the runs one at a time.
+    def __init__(self, buffer, offset, count, length_bytes):
+        self.buffer = buffer  # the whole positions stream
+        self.offset = offset
+        self.count = count
+        self.length_bytes = length_bytes
+        self.starts = None
+
+    def __len__(self):
+        return self.count
+
+    def run_starts(self):
+        # Concurrent first calls compute the same offsets, so no lock is needed
+        lengths = decode_varints(self.buffer[self.offset:self.offset + self.length_bytes])
+        starts = np.empty(self.count + 1, dtype=np.int64)
+        starts[0] = self.offset + self.length_bytes
+        np.cumsum(lengths, out=starts[1:])
+        starts[1:] += starts[0]
+        # Indexing a memoryview gives plain ints, which slice the buffer faster
+        self.starts = memoryview(starts)
+        return self.starts
+
+    def positions(self, i):
+        starts = self.starts if self.starts is not None else self.run_starts()
+        return decode_run(self.buffer[starts[i]:starts[i + 1]].tobytes())
+
+    def all_positions(self):
+        # Every posting's positions at once, for rewriting the list
+        starts = np.asarray(self.starts if self.starts is not None else self.run_starts())
+        data = np.frombuffer(self.buffer[starts[0]:starts[-1]], dtype=np.uint8)
+        # A run holds as many positions as varints ending (high bit clear) in it
+        ended = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(data < 0x80, out=ended[1:])
+        position_starts = ended[starts - starts[0]]
+        running = np.cumsum(decode_varints(data))
+        before = np.concatenate(([0], running))[position_starts[:-1]]
+        positions = (running - np.repeat(before, np.diff(position_starts))).tolist()
+        return [positions[start:end] for start, end in zip(position_starts[:-1].tolist(), position_starts[1:].tolist())]
+
+
+class PositionList:
+    # Positions of a postings list made of parts: (PositionRuns, indexes of the postings
+    # kept from it, or None for all of them), in posting order
+    def __init__(self, parts):
+        self.parts = parts
+        self.ends = np.cumsum([len(runs) if kept is None else len(kept) for runs, kept in parts]).tolist()
+
+    def __getitem__(self, i):
+        if len(self.parts) == 1:
+            runs, kept = self.parts[0]
+            return runs.positions(i if kept is None else kept[i])
+        part = bisect_right(self.ends, i)
+        runs, kept = self.parts[part]
+        if part:
+            i -= self.ends[part - 1]
+        return runs.positions(i if kept is None else kept[i])
+
+    def all_positions(self):
+        positions = []
+        for runs, kept in self.parts:
+            decoded = runs.all_positions()
+            positions.extend(decoded if kept is None else [decoded[i] for i in kept.tolist()])
+        return positions
+
+    @property
+    def nbytes(self):
+        # Kept indexes, and the run offsets once they are decoded
+        return sum((runs.count + 1) * 8 + (0 if kept is None else kept.nbytes) for runs, kept in self.parts)
+
+    def select(self, keep):
+        parts = []
+        start = 0
+        for (runs, kept), end in zip(self.parts, self.ends):
+            indexes = np.flatnonzero(keep[start:end])
+            if len(indexes):
+                parts.append((runs, indexes if kept is None else kept[indexes]))
+            start = end
+        return PositionList(parts)
+
+
+class Postings:
+    def __init__(self, doc_ids, scores, positions):
+        self.doc_ids = doc_ids  # int32, ascending
+        self.scores = scores  # float32, weights as decoded and tf-idf once served by IndexReader
+        self.positions = positions  # PositionList, decoded on demand
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def positions_at(self, i):
+        return self.positions[i]
+
+    def with_scores(self, scores):
+        return Postings(self.doc_ids, scores, self.positions)
+
+    def select(self, keep):
+        # Postings where the boolean mask keep is set
+        return Postings(self.doc_ids[keep], self.scores[keep], self.positions.select(keep))
+
+    def to_lists(self):
+        # Back to the [[doc_id, weight, [positions]], ...] form encode_postings takes
+        return [[doc_id, weight, positions]
+                for doc_id, weight, positions in zip(self.doc_ids.tolist(), self.scores.tolist(),
+                                                     self.positions.all_positions())]
+
+
+def concat_postings(parts):
+    # Joins postings of consecutive doc_id ranges into one list
+    if len(parts) == 1:
+        return parts[0]
+    return Postings(np.concatenate([part.doc_ids for part in parts]),
+                    np.concatenate([part.scores for part in parts]),
+                    PositionList([position_part for part in parts for position_part in part.positions.parts]))
+
+
+def rebase_positions(buffer, offset, shift):
+    # Moves the positions offset in the header of the block at offset by shift, for
+    # blocks whose positions stream is appended to another one
+    count, doc_len, positions_offset, length_bytes = HEADER.unpack_from(buffer, offset)
+    HEADER.pack_into(buffer, offset, count, doc_len, positions_offset + shift, length_bytes)
+
+
+def decode_postings(buf, positions_buffer):
+    # Decodes doc_ids and weights; positions stay in positions_buffer until asked for
+    count, doc_len, positions_offset, length_bytes = HEADER.unpack_from(buf, 0)
+    offset = HEADER.size
+    # int32 halves the memory traffic of the gathers and scatters queries do over
+    # doc_ids, which stay below 2**31 like in the link graph
+    doc_ids = np.cumsum(decode_varints(buf[offset:offset + doc_len]), dtype=np.int32)
+    offset += doc_len
+    scores = np.frombuffer(buf, dtype='<f4', count=count, offset=offset)
+    return Postings(doc_ids, scores, PositionList([(PositionRuns(positions_buffer, positions_offset, count, length_bytes), None)]))
@@ -0,0 +1,67 @@
+import heapq
+
+# Upper bound of the proximity bonus MAX_PROXIMITY_BONUS / (1 + span / (terms - 1)),
+# span being the length of the smallest window of the page that holds every term
+MAX_PROXIMITY_BONUS = 2.0
+
+
+def closest_distance(positions_a, positions_b):
+    # Smallest distance between a position of one term and one of the other
+    i, j = 0, 0
+    best = float('inf')
+    while i < len(positions_a) and j < len(positions_b):
+        distance = abs(positions_a[i] - positions_b[j])
+        if distance < best:
+            best = distance
+        if positions_a[i] < positions_b[j]:
+            i += 1
+        else:
+            j += 1
+    return best
+
+
+def minimal_window(terms_positions):
+    # Span of the smallest window holding a position of every term. The lists are
+    # merged through a heap of their current positions; the window of the current
+    # positions runs from the heap top to the largest of them, and only advancing the
+    # list at the top can shorten it, so the merge stops when that list runs out.
+    heap = [(positions[0], k, 0) for k, positions in enumerate(terms_positions)]
+    heapq.heapify(heap)
+    high = max(position for position, _, _ in heap)
+    best = float('inf')
+    while True:
+        low, k, i = heap[0]
+        if high - low < best:
+            best = high - low
+        i += 1
+        positions = terms_positions[k]
+        if i == len(positions):
+            return best
+        position = positions[i]
+        if position > high:
+            high = position
+        heapq.heapreplace(heap, (position, k, i))
+
+
+def proximity_bonus(terms_positions):
+    # terms_positions: the sorted positions of each distinct query term in one page.
+    # Two terms' window is their closest pair, which the two-pointer walk finds faster.
+    count = len(terms_positions)
+    if count < 2 or not all(terms_positions):
+        return 0.0
+    if count == 2:
+        span = closest_distance(*terms_positions)
+    else:
+        span = minimal_window(terms_positions)
+    return MAX_PROXIMITY_BONUS / (1 + span / (count - 1))
+
+
+def contains_phrase(phrase_terms, term_positions):
+    # Whether the terms occur in this order at consecutive positions.
+    # term_positions: term -> its sorted positions in the page
+    starts = set(term_positions[phrase_terms[0]])
+    for offset, term in enumerate(phrase_terms[1:], 1):
+        starts.intersection_update([position - offset for position in term_positions[term]])
+        if not starts:
+            return False
+    return True
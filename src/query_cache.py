@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    # Thread-safe LRU cache with an optional time to live.
+    # max_size bounds the summed size_of(value) of the entries (1 per entry by default),
+    # 0 disables the cache. Entries older than ttl seconds are treated as misses.
+    def __init__(self, max_size, ttl=None, size_of=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size_of = size_of or (lambda value: 1)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, size, expiry time)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl and entry[2] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        size = self.size_of(value)
+        if size > self.max_size:
+            # Would evict everything else and still not fit
+            return
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expiry)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+
+def postings_nbytes(postings):
+    # Memory held by a decoded Postings; its positions stay in the mapped file
+    return postings.doc_ids.nbytes + postings.scores.nbytes + postings.positions.nbytes
+
+
+def index_generation(*paths):
+    # mtime and size of the files (or directories) that change whenever the index does
+    generation = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            generation.append(None)
+            continue
+        generation.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(generation)
@@ -1,135 +1,326 @@
-import json
-from nltk.stem import PorterStemmer
-from config import FINAL_INDEX_DIR, DOC_MAPPING_FILE, TOKEN_RETRIEVAL_OFFSET_FILE, PAGERANK_FILE
-from parse_file import load_token_data
+from config import (
+    PAGERANK_FILE,
+    SEGMENTS_DIR,
+    NUM_SHARDS,
+    SEARCH_MODE,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    POSTINGS_CACHE_BYTES
+)
+from index_reader import IndexReader, SharedPostings
+from metrics import REGISTRY, add_time
+from proximity import MAX_PROXIMITY_BONUS, proximity_bonus
+from query_cache import LRUCache, index_generation
+from segments import open_index, index_directories, index_docs, manifest_path
+from stores import PageRankStore
+from tokenizer import Tokenizer
+from top_k import max_score_top_k, tiered_top_k, vectorized_top_k, phrase_top_k
+import shards
+import threading
 import time
-from itertools import combinations
 
-doc_map = None
-stemer = None
-token_retrieval_offset_map = None
-pagerank_scores = None
-
-def pre_loading_files():
-    global doc_map, stemer, token_retrieval_offset_map, pagerank_scores
-
-    stemer = PorterStemmer()
-
-    with open(DOC_MAPPING_FILE, 'r') as file:
-        doc_map = json.load(file)
-
-    with open(TOKEN_RETRIEVAL_OFFSET_FILE, 'r') as file:
-        token_retrieval_offset_map = json.load(file)
-
-    with open(PAGERANK_FILE, 'r') as file:
-        pagerank_scores = json.load(file)
-
-def search_with_query(query, limit=100):
-    start_time = time.time()
-
-    global stemer, doc_map, token_retrieval_offset_map, pagerank_scores
-
-    results = []
-
-    stemmed_terms = sorted([stemer.stem(term) for term in query.strip().split()])
-
-    docs_scores_map = {}
-    docs_positions_map = {}
-
-    previous_letter = None
-    file = None
-
-    for term in stemmed_terms:
-        if term not in token_retrieval_offset_map:
-            continue
-
-        starting_letter = term.lower()[0]
-
-        if starting_letter != previous_letter:
-            if file:
-                file.close()
-            file = open(f"{FINAL_INDEX_DIR}/{starting_letter}_tokens.txt", 'r')
-            previous_letter = starting_letter
-
-        for posting in load_token_data(file, token_retrieval_offset_map[term]):
-            doc_id = posting[0]
-            tfidf_score = posting[1]
-            positions = posting[2]
-
-            if doc_id in docs_scores_map:
-                docs_scores_map[doc_id] += tfidf_score
-            else:
-                docs_scores_map[doc_id] = tfidf_score
-
-            if doc_id not in docs_positions_map:
-                docs_positions_map[doc_id] = {}
-            docs_positions_map[doc_id][term] = positions
-
-    if file:
-        file.close()
-
-    unique_terms = set(stemmed_terms)
-
-
-    if len(stemmed_terms) > 1 and len(unique_terms) > 1:
-        for doc_id in docs_scores_map.keys():
-
-            if doc_id in docs_positions_map and all(term in docs_positions_map[doc_id] for term in unique_terms):
-                terms_positions = [docs_positions_map[doc_id][t] for t in unique_terms]
-
-                # Compute minimal pairwise distances between terms
-                pairwise_distances = []
-                for (pos_a, pos_b) in combinations(terms_positions, 2):
-                    i, j = 0, 0
-                    local_min_dist = float('inf')
-                    while i < len(pos_a) and j < len(pos_b):
-                        dist = abs(pos_a[i] - pos_b[j])
-                        if dist < local_min_dist:
-                            local_min_dist = dist
-                        if pos_a[i] < pos_b[j]:
-                            i += 1
-                        else:
-                            j += 1
-                    pairwise_distances.append(local_min_dist)
-
-                if pairwise_distances:
-                    avg_min_distance = sum(pairwise_distances) / len(pairwise_distances)
-                    bonus = 2.0 / (1 + avg_min_distance)
-                    docs_scores_map[doc_id] += bonus
-
-
-    for doc_id in docs_scores_map:
-        pr_score = pagerank_scores.get(str(doc_id), 0.0)
-        docs_scores_map[doc_id] += pr_score
-
-
-    if docs_scores_map:
-        sorted_results = sorted(docs_scores_map.items(), key=lambda x: x[1], reverse=True)
-        sorted_results = sorted_results[:limit]
+EXCLUDED_EXTENSIONS = ('.txt', '.php', '.pdf', ".sql", ".log", ".htm")
+
+# Stages a query's time is split into: stemming, result cache lookup, term and posting
+# cache lookups, posting list decoding, scoring, the proximity bonus and PageRank
+# lookups within scoring (only timed on request), url filtering, and the shard round
+# trips of a sharded index
+STAGES = ('stem', 'cache', 'fetch', 'decode', 'score', 'proximity', 'pagerank', 'filter', 'shards')
+
+SEARCH_QUERIES = REGISTRY.counter('search_queries_total', "Queries answered", ('mode', 'cached'))
+SEARCH_SECONDS = REGISTRY.histogram('search_seconds', "Time to answer a query", ('mode',))
+SEARCH_STAGE_SECONDS = REGISTRY.histogram('search_stage_seconds', "Time of a query spent in each stage", ('stage',))
+
+def timed(function, timings, stage):
+    # function, with the time of every call added to timings[stage]
+    def call(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            add_time(timings, stage, start)
+    return call
+
+
+class LoadedIndex:
+    # One generation of the index as mapped by a Searcher. It is never changed after
+    # __init__, a reload builds a new one, so a query that took a reference keeps a
+    # consistent view while other threads move on to the next generation.
+    # The stores only map their files on first use, so loading returns almost immediately.
+    def __init__(self, directory, generation):
+        self.generation = generation
+        self.pagerank_scores = PageRankStore(PAGERANK_FILE)
+        self.index_reader = None
+        if directory is None:
+            # Coordinator of a sharded index, the shard workers hold the postings
+            self.doc_map = index_docs([open_index(shard_directory)[1] for shard_directory in index_directories()])
+            return
+        manifest, segments, tombstones = open_index(directory)
+        self.doc_map = index_docs([segments])
+        # A replaced reader is not closed, queries still running on it unmap it when they finish
+        self.index_reader = IndexReader(segments, tombstones, POSTINGS_CACHE_BYTES)
+
+    def pagerank_of(self, doc_id):
+        return self.pagerank_scores.get(doc_id)
+
+    def scoring_functions(self, timings=None):
+        # The proximity bonus and PageRank lookup, timed per call if timings is given
+        if timings is None:
+            return proximity_bonus, self.pagerank_of
+        return timed(proximity_bonus, timings, 'proximity'), timed(self.pagerank_of, timings, 'pagerank')
+
+    def term_stats(self, terms):
+        # Document count and df of the terms, summed into the global idf over shards
+        dfs = {}
+        for term in terms:
+            located = self.index_reader.locate(term)
+            if located:
+                dfs[term] = self.index_reader.df(located)
+        return self.index_reader.total_docs, dfs
+
+    def score_exhaustive(self, stemmed_terms, idf=None, reader=None, timings=None):
+        # Scores every document that contains a query term
+        reader = reader or self.index_reader
+        proximity, pagerank_of = self.scoring_functions(timings)
+        docs_scores_map = {}
+        docs_positions_map = {}
+        unique_terms = set(stemmed_terms)
+        # Only a query of several distinct terms gets the proximity bonus
+        bonus_possible = len(stemmed_terms) > 1 and len(unique_terms) > 1
+
+        for term in stemmed_terms:
+            postings = reader.postings(term, idf.get(term) if idf else None)
+            if postings is None:
+                continue
 
-        excluded_extensions = ('.txt', '.php', '.pdf', ".sql", ".log", ".htm")
-        filtered_results = []
+            for i, (doc_id, tfidf_score) in enumerate(zip(postings.doc_ids.tolist(), postings.scores.tolist())):
+                if doc_id in docs_scores_map:
+                    docs_scores_map[doc_id] += tfidf_score
+                else:
+                    docs_scores_map[doc_id] = tfidf_score
+
+                # Positions are only decoded if the proximity bonus needs them
+                if bonus_possible:
+                    if doc_id not in docs_positions_map:
+                        docs_positions_map[doc_id] = {}
+                    docs_positions_map[doc_id][term] = (postings, i)
+
+        if bonus_possible:
+            for doc_id in docs_scores_map.keys():
+
+                if doc_id in docs_positions_map and all(term in docs_positions_map[doc_id] for term in unique_terms):
+                    terms_positions = []
+                    for t in unique_terms:
+                        postings, i = docs_positions_map[doc_id][t]
+                        terms_positions.append(postings.positions_at(i))
+                    docs_scores_map[doc_id] += proximity(terms_positions)
+
+        for doc_id in docs_scores_map:
+            docs_scores_map[doc_id] += pagerank_of(doc_id)
+
+        # Ties are broken by doc_id so every scoring path returns the same order
+        sorted_results = sorted(docs_scores_map.items(), key=lambda x: (-x[1], x[0]))
+        return sorted_results
+
+    def rank(self, stemmed_terms, limit, mode, idf=None, reader=None, timings=None):
+        # Top limit (doc_id, score) of this index.
+        # idf: term -> idf of the whole index when this is one shard of it
+        # reader: a SharedPostings of a batch in place of the index reader
+        # timings: dict that gets the time of proximity and PageRank calls added
+        idf = idf or {}
+        index_reader = reader or self.index_reader
+        proximity, pagerank_of = self.scoring_functions(timings)
+        if mode == 'exhaustive':
+            sorted_results = self.score_exhaustive(stemmed_terms, idf, index_reader, timings)[:limit]
+        elif mode == 'phrase':
+            # stemmed_terms is the phrase, in query order
+            term_postings = {}
+            for term in set(stemmed_terms):
+                postings = index_reader.postings(term, idf.get(term))
+                if postings is not None:
+                    term_postings[term] = postings
+            sorted_results = phrase_top_k(stemmed_terms, term_postings, limit, pagerank_of, proximity, MAX_PROXIMITY_BONUS)
+        elif mode == 'vectorized':
+            term_postings = {}
+            for term in set(stemmed_terms):
+                postings = index_reader.postings(term, idf.get(term))
+                if postings is not None:
+                    term_postings[term] = postings
+            sorted_results = vectorized_top_k(stemmed_terms, term_postings, limit, self.pagerank_scores.array(),
+                                              proximity, MAX_PROXIMITY_BONUS)
+        else:
+            sorted_results = None
+            if mode == 'tiered':
+                term_tiers = {}
+                for term in set(stemmed_terms):
+                    tier = index_reader.champions(term, idf.get(term))
+                    if tier is not None:
+                        term_tiers[term] = tier
+                sorted_results = tiered_top_k(stemmed_terms, term_tiers, limit, pagerank_of,
+                                              self.pagerank_scores.max(), proximity, MAX_PROXIMITY_BONUS)
+
+            # The champion tiers could not prove the top k, read the full lists
+            if sorted_results is None:
+                term_postings = {}
+                for term in set(stemmed_terms):
+                    postings = index_reader.postings(term, idf.get(term))
+                    if postings is not None:
+                        term_postings[term] = (postings, index_reader.max_score(term, idf.get(term)))
+                sorted_results = max_score_top_k(stemmed_terms, term_postings, limit, pagerank_of,
+                                                 self.pagerank_scores.max(), proximity, MAX_PROXIMITY_BONUS)
+        return sorted_results or []
+
+
+class Searcher:
+    # Answers queries over the index, or over one shard of it with directory set.
+    # All request threads share one Searcher: the index structures are read-only
+    # mappings, the caches are locked, and a changed index is swapped in as a new
+    # LoadedIndex. Pre-forked servers load it before forking, so the workers share
+    # the mapped pages through the page cache.
+    def __init__(self, directory=None):
+        self.directory = directory or (None if NUM_SHARDS > 1 else SEGMENTS_DIR)
+        # Stems query terms through its cache, and splits phrases into the stemmed
+        # tokens the indexer gave positions to
+        self.tokenizer = Tokenizer()
+        # Result lists of recent queries, keyed on the index generation, the sorted
+        # stemmed terms, the limit and the scoring mode
+        self.query_cache = LRUCache(QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+        self.reload_lock = threading.Lock()
+        # Shard workers reload their shard on their own when it changes
+        self.coordinator = shards.ShardCoordinator(shards.start_shards()) if self.directory is None else None
+        self.index = LoadedIndex(self.directory, self.current_generation())
+
+    def current_generation(self):
+        # Every change to the index publishes a new manifest
+        if self.directory is None:
+            return index_generation(*(manifest_path(directory) for directory in index_directories()))
+        return index_generation(manifest_path(self.directory))
+
+    def current_index(self):
+        # Picks up a rebuilt index, which also retires every cached result of the old one
+        index = self.index
+        if self.current_generation() != index.generation:
+            with self.reload_lock:
+                generation = self.current_generation()
+                if generation != self.index.generation:
+                    print("Index changed on disk, reloading")
+                    self.index = LoadedIndex(self.directory, generation)
+                    self.query_cache.clear()
+                index = self.index
+        return index
+
+    def cache_stats(self):
+        index_reader = self.index.index_reader
+        return {
+            'queries': self.query_cache.stats(),
+            'postings': index_reader.postings_cache.stats() if index_reader else None,
+            'stems': self.tokenizer.stems.stats(),
+        }
+
+    def stem_query(self, query, mode=SEARCH_MODE):
+        # Query terms, sorted, or in query order for a phrase
+        if mode == 'phrase':
+            return self.tokenizer.tokenize_and_filter(query)
+        return sorted([self.tokenizer.stem(term) for term in query.strip().split()])
+
+    def query_mode(self, query, mode):
+        # A query in double quotes is searched as a phrase
+        query = query.strip()
+        if len(query) > 2 and query[0] == query[-1] == '"':
+            return 'phrase'
+        return mode
+
+    def term_stats(self, terms):
+        return self.current_index().term_stats(terms)
+
+    def rank(self, stemmed_terms, limit, mode, idf=None):
+        return self.index.rank(stemmed_terms, limit, mode, idf)
+
+    def ranked_urls(self, index, reader, stemmed_terms, limit, mode, stages, detailed=False):
+        # stages: dict of the query's stage timings, see STAGES
+        start = time.perf_counter()
+        if self.coordinator is not None:
+            sorted_results = self.coordinator.top_k(stemmed_terms, limit, mode)
+            start = add_time(stages, 'shards', start)
+        else:
+            reader.timings = stages
+            timed_inside = ('fetch', 'decode', 'proximity', 'pagerank')
+            before = sum(stages.get(stage, 0.0) for stage in timed_inside)
+            sorted_results = index.rank(stemmed_terms, limit, mode, reader=reader, timings=stages if detailed else None)
+            now = time.perf_counter()
+            # Whatever ranking spent outside the separately timed stages is scoring
+            inside = sum(stages.get(stage, 0.0) for stage in timed_inside) - before
+            stages['score'] = stages.get('score', 0.0) + now - start - inside
+            start = now
+
+        urls = []
         for doc_id, score in sorted_results:
-            url = doc_map[str(doc_id)]
-            if url.lower().endswith(excluded_extensions) or '?' in url:
+            url = index.doc_map[doc_id]
+            if url.lower().endswith(EXCLUDED_EXTENSIONS) or '?' in url:
                 continue
-            filtered_results.append((doc_id, score))
+            urls.append((url, score))
+        add_time(stages, 'filter', start)
+        return urls
+
+    def search(self, query, limit=100, mode=SEARCH_MODE, timings=None, use_cache=True, detailed=False):
+        # [(url, score)] best first, and whether it came from the result cache.
+        # timings: dict that gets the seconds spent in each stage added, see STAGES.
+        # detailed: also time the proximity and PageRank calls within scoring, which
+        # costs a little for every scored document
+        return self.search_batch([query], limit, mode, timings, use_cache, detailed)[0]
+
+    def search_batch(self, queries, limit=100, mode=SEARCH_MODE, timings=None, use_cache=True, detailed=False):
+        # search() for every query. The batch runs on one index generation and reads
+        # each term's postings once however many of its queries use the term.
+        index = self.current_index()
+        reader = SharedPostings(index.index_reader) if index.index_reader else None
+        answers = []
+        for query in queries:
+            query_start = start = time.perf_counter()
+            stages = {}
+            query_mode = self.query_mode(query, mode)
+            stemmed_terms = self.stem_query(query, query_mode)
+            start = add_time(stages, 'stem', start)
+
+            cache_key = (index.generation, tuple(stemmed_terms), limit, query_mode)
+            urls = self.query_cache.get(cache_key) if use_cache else None
+            add_time(stages, 'cache', start)
+            cached = urls is not None
+            if not cached:
+                urls = self.ranked_urls(index, reader, stemmed_terms, limit, query_mode, stages, detailed)
+                self.query_cache.put(cache_key, urls)
+            answers.append((urls, cached))
+
+            SEARCH_QUERIES.inc(mode=query_mode, cached=str(cached).lower())
+            SEARCH_SECONDS.observe(time.perf_counter() - query_start, mode=query_mode)
+            for stage, seconds in stages.items():
+                SEARCH_STAGE_SECONDS.observe(seconds, stage=stage)
+                if timings is not None:
+                    timings[stage] = timings.get(stage, 0.0) + seconds
+        return answers
+
+
+# The command line and the Tk interface search through one module level Searcher
+searcher = None
 
-        for doc_id, score in filtered_results:
-            url = doc_map[str(doc_id)]
-            print(url, "(score:", score, ")")
-            results.append({
-                'url': url,
-                'title': url.split('/')[-1] or url
-            })
+def pre_loading_files():
+    global searcher
+    searcher = Searcher()
 
-    end_time = time.time()
-    print(f'\nThis search took {end_time - start_time} seconds\n')
+def cache_stats():
+    return searcher.cache_stats()
 
-    return results
+def search_with_query(query, limit=100, mode=SEARCH_MODE):
+    urls, cached = searcher.search(query, limit, mode)
+    return [{'url': url, 'title': url.split('/')[-1] or url} for url, score in urls]
 
 if __name__ == "__main__":
     pre_loading_files()
     while True:
         query = input("Please enter your query here:")
-        search_with_query(query, limit=100)
+        start_time = time.time()
+        urls, cached = searcher.search(query, limit=100)
+        for url, score in urls:
+            print(url, "(score:", score, ")")
+        end_time = time.time()
+        print(f'\nThis search took {end_time - start_time} seconds{" (cached)" if cached else ""}\n')
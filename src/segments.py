@@ -0,0 +1,319 @@
+import fcntl
+import heapq
+import json
+import mmap
+import os
+import shutil
+from contextlib import contextmanager
+from itertools import groupby
+import numpy as np
+from config import SEGMENTS_DIR, SHARDS_DIR, NUM_SHARDS
+from parse_file import write_token_postings
+from postings import rebase_positions
+from stores import MappedFile, DocStore, TermTable, write_replacing, write_term_table, write_doc_store
+
+# The index is a list of immutable segments, each a directory with its own postings,
+# term table and documents. The manifest names the live segments, oldest first, and
+# the file of tombstoned (replaced) documents. Writers build a segment under a
+# temporary name and publish it by renaming it and replacing the manifest, so a search
+# sees either the old list of segments or the new one, never a half-written index.
+#
+# Doc_ids are never reused, a new segment starts above all earlier ones and merges only
+# combine neighbours, so a term's postings concatenated in segment order are still
+# sorted by doc_id.
+#
+# With NUM_SHARDS > 1 documents are partitioned by doc_id % NUM_SHARDS and every shard
+# is such an index of its own, in SHARDS_DIR/shard_<n>.
+
+SEGMENT_POSTINGS = 'postings.bin'
+SEGMENT_POSITIONS = 'positions.bin'
+SEGMENT_TERMS = 'terms.bin'
+SEGMENT_DOCS = 'doc_mapping.bin'
+
+
+def shard_path(shard):
+    return os.path.join(SHARDS_DIR, f"shard_{shard}")
+
+
+def index_directories():
+    # Directory of every independently searchable index, one per shard
+    if NUM_SHARDS <= 1:
+        return [SEGMENTS_DIR]
+    directories = [shard_path(shard) for shard in range(NUM_SHARDS)]
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    return directories
+
+
+def shard_of(doc_id):
+    return doc_id % NUM_SHARDS if NUM_SHARDS > 1 else 0
+
+
+class Segment:
+    def __init__(self, name, directory=SEGMENTS_DIR):
+        directory = segment_path(name, directory)
+        self.name = name
+        self.terms = TermTable(os.path.join(directory, SEGMENT_TERMS))
+        self.docs = DocStore(os.path.join(directory, SEGMENT_DOCS))
+        self.postings_file = MappedFile(os.path.join(directory, SEGMENT_POSTINGS))
+        self.positions_file = MappedFile(os.path.join(directory, SEGMENT_POSITIONS))
+        # Mapped right away, so the files stay readable after a merge removes the directory
+        for mapped_file in (self.terms.mapped_file, self.docs.mapped_file, self.postings_file, self.positions_file):
+            mapped_file.buffer()
+
+    def buffer(self):
+        return self.postings_file.buffer()
+
+    def positions_buffer(self):
+        return self.positions_file.buffer()
+
+    def close(self):
+        self.postings_file.close()
+        self.positions_file.close()
+
+
+class SegmentWriter:
+    # Builds one segment in a temporary directory that publish() later renames.
+    # Writers of consecutive term ranges can build parts in parallel, under their own
+    # name, that the segment's writer then appends in term order.
+    def __init__(self, directory=SEGMENTS_DIR, name=None):
+        self.directory = segment_path(name or f"new_{os.getpid()}.tmp", directory)
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.postings_file = open(os.path.join(self.directory, SEGMENT_POSTINGS), 'wb')
+        self.positions_file = open(os.path.join(self.directory, SEGMENT_POSITIONS), 'wb')
+        self.token_retrieval_offset_map = {}
+
+    def add(self, token, postings, pagerank_scores=None, idf=1.0):
+        # postings: [[doc_id, weight, [positions]], ...] sorted by doc_id
+        self.token_retrieval_offset_map[token] = write_token_postings(self.postings_file, self.positions_file, token, postings, pagerank_scores, idf)
+
+    def close(self):
+        # Ends a part, whose directory and offset table go to append()
+        self.postings_file.close()
+        self.positions_file.close()
+        return self.directory, self.token_retrieval_offset_map
+
+    def discard(self):
+        # Removes the working directory of a build that failed before publishing it
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def append(self, part_directory, offset_map):
+        # Adds the terms of a part written by another writer, all of them after this
+        # writer's terms, and removes the part
+        postings_base = self.postings_file.tell()
+        positions_base = self.positions_file.tell()
+        part_postings = os.path.join(part_directory, SEGMENT_POSTINGS)
+        if positions_base and os.path.getsize(part_postings):
+            with open(part_postings, 'r+b') as f, mmap.mmap(f.fileno(), 0) as data:
+                for entry in offset_map.values():
+                    rebase_positions(data, entry[0], positions_base)
+                    if len(entry) == 7:
+                        rebase_positions(data, entry[4], positions_base)
+        for name, target in ((SEGMENT_POSTINGS, self.postings_file), (SEGMENT_POSITIONS, self.positions_file)):
+            with open(os.path.join(part_directory, name), 'rb') as f:
+                shutil.copyfileobj(f, target)
+        for token, entry in offset_map.items():
+            entry = list(entry)
+            entry[0] += postings_base
+            if len(entry) == 7:
+                entry[4] += postings_base
+            self.token_retrieval_offset_map[token] = entry
+        shutil.rmtree(part_directory)
+
+    def finish(self, doc_mapping=None, doc_store_path=None):
+        # Documents come as a doc_id -> url dict or as an already written doc store
+        self.close()
+        write_term_table(self.token_retrieval_offset_map, os.path.join(self.directory, SEGMENT_TERMS))
+        if doc_store_path:
+            shutil.copyfile(doc_store_path, os.path.join(self.directory, SEGMENT_DOCS))
+        else:
+            write_doc_store(doc_mapping, os.path.join(self.directory, SEGMENT_DOCS))
+        return self.directory
+
+
+def segment_path(name, directory=SEGMENTS_DIR):
+    return os.path.join(directory, name)
+
+
+def manifest_path(directory=SEGMENTS_DIR):
+    return os.path.join(directory, 'manifest.json')
+
+
+def read_manifest(directory=SEGMENTS_DIR):
+    if not os.path.exists(manifest_path(directory)):
+        return {'generation': 0, 'next_segment': 1, 'segments': [], 'tombstones': None}
+    with open(manifest_path(directory), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@contextmanager
+def file_lock(path):
+    with open(path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def manifest_lock(directory=SEGMENTS_DIR):
+    # Serializes manifest updates of indexing and merging processes
+    return file_lock(os.path.join(directory, 'manifest.lock'))
+
+
+def update_lock():
+    # Serializes the processes that hand out doc_ids or rewrite the files next to the
+    # index (links, PageRank, df and idf, simhash fingerprints): incremental updates,
+    # for their whole run, and the merger while it publishes a rebuild. An update's
+    # doc_ids then stay free until it has published, and no update rewrites those
+    # files from a copy another one has replaced meanwhile. Taken before manifest_lock.
+    return file_lock(os.path.join(SEGMENTS_DIR, 'update.lock'))
+
+
+def publish(update_segments, new_segment_directory=None, update_tombstones=None, directory=SEGMENTS_DIR):
+    # Moves the index to its next manifest.
+    # update_segments(manifest, new_name) returns the new segment list from the current
+    # manifest, which may be newer than the one the caller started from, and the name
+    # the new segment gets. update_tombstones(tombstones), if given, returns the new
+    # tombstone doc_ids from the current ones.
+    with manifest_lock(directory):
+        manifest = read_manifest(directory)
+        generation = manifest['generation'] + 1
+        new_name = f"seg_{manifest['next_segment']}" if new_segment_directory else None
+        try:
+            segments = update_segments(manifest, new_name)
+        except Exception:
+            if new_segment_directory:
+                shutil.rmtree(new_segment_directory)
+            raise
+        if new_segment_directory:
+            os.rename(new_segment_directory, segment_path(new_name, directory))
+
+        tombstone_file = manifest['tombstones']
+        if update_tombstones:
+            tombstones = np.unique(np.asarray(update_tombstones(load_tombstones(manifest, directory)), dtype='<u8'))
+            tombstone_file = None
+            if len(tombstones):
+                tombstone_file = f"tombstones_{generation}.bin"
+                write_replacing(segment_path(tombstone_file, directory), [tombstones.tobytes()])
+
+        new_manifest = {
+            'generation': generation,
+            'next_segment': manifest['next_segment'] + (1 if new_name else 0),
+            'segments': segments,
+            'tombstones': tombstone_file,
+        }
+        write_replacing(manifest_path(directory), [json.dumps(new_manifest, indent=2).encode('utf-8')])
+        remove_unreferenced(new_manifest, directory)
+    return new_manifest
+
+
+def remove_unreferenced(manifest, directory=SEGMENTS_DIR):
+    # Searches that still have a dropped segment mapped keep reading it until they reload
+    live = set(manifest['segments'])
+    live.add(manifest['tombstones'])
+    for name in os.listdir(directory):
+        if name in live:
+            continue
+        if name.startswith('seg_'):
+            shutil.rmtree(segment_path(name, directory))
+        elif name.startswith('tombstones_'):
+            os.remove(segment_path(name, directory))
+
+
+def open_segments(manifest, directory=SEGMENTS_DIR):
+    return [Segment(name, directory) for name in manifest['segments']]
+
+
+def open_index(directory=SEGMENTS_DIR):
+    # The manifest with its segments and tombstones. A publish can remove a segment
+    # between reading the manifest and opening it, then the newer manifest is used.
+    # A file missing from a manifest that did not change is an error.
+    manifest = read_manifest(directory)
+    while True:
+        try:
+            return manifest, open_segments(manifest, directory), load_tombstones(manifest, directory)
+        except FileNotFoundError:
+            current = read_manifest(directory)
+            if current['generation'] == manifest['generation']:
+                raise
+            manifest = current
+
+
+def load_tombstones(manifest, directory=SEGMENTS_DIR):
+    # Sorted doc_ids of replaced documents
+    if not manifest['tombstones']:
+        return np.empty(0, dtype=np.int64)
+    return np.fromfile(segment_path(manifest['tombstones'], directory), dtype='<u8').astype(np.int64)
+
+
+def all_terms(segments):
+    # Sorted union of the segments' terms
+    for term, _ in groupby(heapq.merge(*(segment.terms.terms() for segment in segments))):
+        yield term
+
+
+class SegmentDocs:
+    # Doc_id -> url over all segments
+    def __init__(self, segments):
+        self.segments = segments
+
+    @property
+    def slots(self):
+        return max((segment.docs.slots for segment in self.segments), default=0)
+
+    def __len__(self):
+        # Tombstoned documents are counted until a merge drops them, like they are in df
+        return sum(len(segment.docs) for segment in self.segments)
+
+    def get(self, doc_id):
+        for segment in reversed(self.segments):
+            if doc_id >= segment.docs.first:
+                return segment.docs.get(doc_id)
+        return None
+
+    def __getitem__(self, doc_id):
+        url = self.get(doc_id)
+        if url is None:
+            raise KeyError(doc_id)
+        return url
+
+    def items(self):
+        for segment in self.segments:
+            yield from segment.docs.items()
+
+
+class ShardedDocs:
+    # Doc_id -> url over the shards' SegmentDocs
+    def __init__(self, shard_docs):
+        self.shard_docs = shard_docs
+
+    @property
+    def slots(self):
+        return max((docs.slots for docs in self.shard_docs), default=0)
+
+    def __len__(self):
+        return sum(len(docs) for docs in self.shard_docs)
+
+    def get(self, doc_id):
+        return self.shard_docs[shard_of(doc_id)].get(doc_id)
+
+    def __getitem__(self, doc_id):
+        url = self.get(doc_id)
+        if url is None:
+            raise KeyError(doc_id)
+        return url
+
+    def items(self):
+        for docs in self.shard_docs:
+            yield from docs.items()
+
+
+def index_docs(shard_segments):
+    # Doc_id -> url for the segment lists of index_directories()
+    if len(shard_segments) == 1:
+        return SegmentDocs(shard_segments[0])
+    return ShardedDocs([SegmentDocs(segments) for segments in shard_segments])
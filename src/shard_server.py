@@ -0,0 +1,43 @@
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import search
+from segments import shard_path
+
+# Serves one shard of a sharded index to a coordinator configured with SHARD_URLS:
+#   python shard_server.py <shard number> <port>
+# POST /stats {"terms": [...]}                          -> {"total_docs": n, "df": {term: df}}
+# POST /top_k {"terms", "limit", "mode", "idf": {...}}  -> {"results": [[doc_id, score], ...]}
+
+class ShardHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        searcher = self.server.searcher
+        if self.path == '/stats':
+            total_docs, df = searcher.term_stats(request['terms'])
+            answer = {'total_docs': total_docs, 'df': df}
+        elif self.path == '/top_k':
+            results = searcher.rank(request['terms'], request['limit'], request['mode'], request['idf'])
+            answer = {'results': [[int(doc_id), float(score)] for doc_id, score in results]}
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python shard_server.py <shard number> <port>")
+        sys.exit(1)
+    shard, port = int(sys.argv[1]), int(sys.argv[2])
+    server = ThreadingHTTPServer(('', port), ShardHandler)
+    server.searcher = search.Searcher(shard_path(shard))
+    print(f"Serving {shard_path(shard)} on port {port}")
+    server.serve_forever()
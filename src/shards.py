@@ -0,0 +1,110 @@
+import heapq
+import json
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from postings import compute_idf_value
+from segments import index_directories
+from config import SHARD_URLS, SHARD_TIMEOUT
+import search
+
+# Scatter-gather search over a document-partitioned index (NUM_SHARDS > 1).
+# Every shard is a complete index of its share of the documents and ranks them on its
+# own. idf has to come from the whole index for the scores to match an unsharded one,
+# so a query takes two rounds: the shards report their document count and the df of
+# the query terms, then they rank with the summed idf. Each returns its top k and the
+# coordinator merges those, ordered like a single index orders them.
+
+
+# Shard side. A shard worker is a process that searches one shard directory with a search.Searcher.
+shard_searcher = None
+
+def init_shard(directory):
+    global shard_searcher
+    shard_searcher = search.Searcher(directory)
+
+def shard_stats(terms):
+    return shard_searcher.term_stats(terms)
+
+def shard_top_k(stemmed_terms, limit, mode, idf):
+    return shard_searcher.rank(stemmed_terms, limit, mode, idf)
+
+
+class LocalShard:
+    # A worker process on this machine
+    def __init__(self, directory):
+        self.executor = ProcessPoolExecutor(max_workers=1, initializer=init_shard, initargs=(directory,))
+
+    def stats(self, terms):
+        return self.executor.submit(shard_stats, terms)
+
+    def top_k(self, stemmed_terms, limit, mode, idf):
+        return self.executor.submit(shard_top_k, stemmed_terms, limit, mode, idf)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class HttpShard:
+    # A shard_server.py, which could as well run on another machine
+    requests = ThreadPoolExecutor()
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def post(self, path, payload):
+        request = urllib.request.Request(self.url + path, data=json.dumps(payload).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=SHARD_TIMEOUT) as response:
+            return json.loads(response.read())
+
+    def stats(self, terms):
+        def request():
+            answer = self.post('/stats', {'terms': terms})
+            return answer['total_docs'], answer['df']
+        return self.requests.submit(request)
+
+    def top_k(self, stemmed_terms, limit, mode, idf):
+        def request():
+            answer = self.post('/top_k', {'terms': stemmed_terms, 'limit': limit, 'mode': mode, 'idf': idf})
+            return [tuple(result) for result in answer['results']]
+        return self.requests.submit(request)
+
+    def close(self):
+        pass
+
+
+def start_shards():
+    if SHARD_URLS:
+        return [HttpShard(url) for url in SHARD_URLS]
+    return [LocalShard(directory) for directory in index_directories()]
+
+
+class ShardCoordinator:
+    def __init__(self, shards):
+        self.shards = shards
+
+    def global_idf(self, terms):
+        stats = [future.result() for future in [shard.stats(terms) for shard in self.shards]]
+        total_docs = sum(shard_docs for shard_docs, _ in stats)
+        idf = {}
+        for term in terms:
+            df = sum(dfs.get(term, 0) for _, dfs in stats)
+            if df:
+                idf[term] = compute_idf_value(df, total_docs)
+        return idf
+
+    def top_k(self, stemmed_terms, limit, mode):
+        # (doc_id, score) like LoadedIndex.rank() on the unsharded index
+        idf = self.global_idf(sorted(set(stemmed_terms)))
+        if not idf:
+            return []
+        futures = [shard.top_k(stemmed_terms, limit, mode, idf) for shard in self.shards]
+        # The shards' lists are already in (-score, doc_id) order, and a document of
+        # the global top k is in its own shard's top k
+        shard_results = [future.result() for future in futures]
+        return list(islice(heapq.merge(*shard_results, key=lambda result: (-result[1], result[0])), limit))
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
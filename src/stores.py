@@ -0,0 +1,308 @@
+import mmap
+import os
+import struct
+import threading
+from array import array
+from itertools import chain
+import numpy as np
+
+# Compact, memory-mapped replacements for the doc mapping, PageRank, offset and link JSON files.
+# Each store maps its file the first time it is used, so loading the search engine
+# costs nothing until a lookup needs the data, and pages are shared between workers.
+
+COUNT = struct.Struct('<Q')
+DOC_HEADER = struct.Struct('<QQQ')  # first doc_id, doc_id slots, documents
+LINK_HEADER = struct.Struct('<QQ')  # nodes, edges
+TERM_RECORD = struct.Struct('<QIdIQId')  # offset, length, max score, df, champion offset, champion length, tail max score
+
+
+class MappedFile:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.file = None
+        self.mapped = None
+        self.data = None
+
+    def buffer(self):
+        if self.data is None:
+            with self.lock:
+                if self.data is None:
+                    self.file = open(self.filepath, 'rb')
+                    if os.path.getsize(self.filepath) == 0:
+                        self.data = memoryview(b'')
+                    else:
+                        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                        self.data = memoryview(self.mapped)
+        return self.data
+
+    def close(self):
+        with self.lock:
+            if self.mapped is not None:
+                try:
+                    self.mapped.close()
+                except BufferError:
+                    # Decoded postings still reference the mapping, it is unmapped once they are gone
+                    pass
+            if self.file is not None:
+                self.file.close()
+            self.file = self.mapped = self.data = None
+
+
+def write_replacing(filepath, chunks):
+    # Readers may have the old file mapped, so the new one is written next to it and
+    # renamed over it instead of being truncated in place
+    temp_path = filepath + '.tmp'
+    with open(temp_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(temp_path, filepath)
+
+
+def write_doc_store(doc_mapping, filepath):
+    # doc_mapping: doc_id -> url. Layout: header, one uint64 offset per doc_id from the
+    # first to the last (+1), url bytes. Delta segments start at a high doc_id, so the
+    # offsets only cover their own range.
+    writer = DocStoreWriter(filepath)
+    for doc_id in sorted(doc_mapping):
+        writer.add(doc_id, doc_mapping[doc_id])
+    writer.finish()
+
+
+class DocStoreWriter:
+    # Writes a doc store from doc_ids added in increasing order. The urls go to a
+    # temporary file as they come, so only the offsets are held in memory.
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.urls_path = filepath + '.urls.tmp'
+        self.urls_file = open(self.urls_path, 'wb')
+        self.first = None
+        self.offsets = array('Q', [0])
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, doc_id, url):
+        if self.first is None:
+            self.first = doc_id
+        # doc_ids without a document get empty ranges
+        while len(self.offsets) < doc_id - self.first + 1:
+            self.offsets.append(self.offsets[-1])
+        encoded = url.encode('utf-8')
+        self.urls_file.write(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+        self.count += 1
+
+    def finish(self):
+        self.urls_file.close()
+        first = self.first if self.first is not None else 0
+        slots = first + len(self.offsets) - 1
+        offsets = np.asarray(self.offsets).astype('<u8', copy=False)
+        with open(self.urls_path, 'rb') as urls:
+            chunks = chain([DOC_HEADER.pack(first, slots, self.count), offsets.tobytes()],
+                           iter(lambda: urls.read(1 << 20), b''))
+            write_replacing(self.filepath, chunks)
+        os.remove(self.urls_path)
+
+
+class DocStore:
+    def __init__(self, filepath):
+        self.mapped_file = MappedFile(filepath)
+
+    def header(self):
+        return DOC_HEADER.unpack_from(self.mapped_file.buffer(), 0)
+
+    @property
+    def first(self):
+        return self.header()[0]
+
+    @property
+    def slots(self):
+        # One more than the largest doc_id
+        return self.header()[1]
+
+    def __len__(self):
+        return self.header()[2]
+
+    def get(self, doc_id):
+        buffer = self.mapped_file.buffer()
+        first, slots, _ = DOC_HEADER.unpack_from(buffer, 0)
+        if not first <= doc_id < slots:
+            return None
+        start, end = struct.unpack_from('<QQ', buffer, DOC_HEADER.size + 8 * (doc_id - first))
+        if start == end:
+            return None
+        urls_start = DOC_HEADER.size + 8 * (slots - first + 1)
+        return bytes(buffer[urls_start + start:urls_start + end]).decode('utf-8')
+
+    def __getitem__(self, doc_id):
+        url = self.get(doc_id)
+        if url is None:
+            raise KeyError(doc_id)
+        return url
+
+    def items(self):
+        for doc_id in range(self.first, self.slots):
+            url = self.get(doc_id)
+            if url is not None:
+                yield doc_id, url
+
+
+def write_pagerank_store(pagerank_scores, slots, filepath):
+    # Dense float64 array indexed by doc_id, 0.0 for documents without a score
+    scores = np.zeros(slots, dtype='<f8')
+    for doc_id, score in pagerank_scores.items():
+        if doc_id < slots:
+            scores[doc_id] = score
+    write_replacing(filepath, [scores.tobytes()])
+
+
+class PageRankStore:
+    def __init__(self, filepath):
+        self.mapped_file = MappedFile(filepath)
+        self.max_score = None
+
+    def array(self):
+        return np.frombuffer(self.mapped_file.buffer(), dtype='<f8')
+
+    def get(self, doc_id):
+        scores = self.array()
+        if 0 <= doc_id < len(scores):
+            return float(scores[doc_id])
+        return 0.0
+
+    def max(self):
+        if self.max_score is None:
+            scores = self.array()
+            self.max_score = float(scores.max()) if len(scores) else 0.0
+        return self.max_score
+
+
+def write_link_graph(adjacency, filepath):
+    # adjacency: (doc_id, [linked doc_ids]) pairs, e.g. streamed from the indexer's link
+    # spill. Layout: header, the nodes' doc_ids (int32, sorted), one uint64 edge offset
+    # per node (+1), edge targets as node numbers (int32): node i links to
+    # targets[offsets[i]:offsets[i + 1]]. The nodes are the given doc_ids and all link
+    # targets, self-links are dropped, so PageRank can use the arrays as they are.
+    sources = array('i')
+    edge_sources = array('i')
+    edge_targets = array('i')
+    for doc_id, targets in adjacency:
+        sources.append(doc_id)
+        edge_sources.extend([doc_id] * len(targets))
+        edge_targets.extend(targets)
+    edge_sources = np.asarray(edge_sources)
+    edge_targets = np.asarray(edge_targets)
+    doc_ids = np.unique(np.concatenate([np.asarray(sources), edge_targets]))
+    keep = edge_sources != edge_targets
+    source_nodes = np.searchsorted(doc_ids, edge_sources[keep])
+    # A stable sort keeps each node's targets in the given order
+    order = np.argsort(source_nodes, kind='stable')
+    targets = np.searchsorted(doc_ids, edge_targets[keep])[order]
+    offsets = np.zeros(len(doc_ids) + 1, dtype='<u8')
+    np.cumsum(np.bincount(source_nodes, minlength=len(doc_ids)), out=offsets[1:])
+    write_replacing(filepath, [LINK_HEADER.pack(len(doc_ids), len(targets)), doc_ids.astype('<i4').tobytes(),
+                               offsets.tobytes(), targets.astype('<i4').tobytes()])
+
+
+class LinkGraph:
+    def __init__(self, filepath):
+        self.mapped_file = MappedFile(filepath)
+
+    def __len__(self):
+        return LINK_HEADER.unpack_from(self.mapped_file.buffer(), 0)[0]
+
+    def arrays(self):
+        # (doc_ids, offsets, targets) over the mapped file, see write_link_graph
+        buffer = self.mapped_file.buffer()
+        nodes, edges = LINK_HEADER.unpack_from(buffer, 0)
+        doc_ids = np.frombuffer(buffer, dtype='<i4', count=nodes, offset=LINK_HEADER.size)
+        offsets = np.frombuffer(buffer, dtype='<u8', count=nodes + 1, offset=LINK_HEADER.size + 4 * nodes)
+        targets = np.frombuffer(buffer, dtype='<i4', count=edges, offset=LINK_HEADER.size + 12 * nodes + 8)
+        return doc_ids, offsets, targets
+
+    def items(self):
+        # (doc_id, [linked doc_ids]) of every node
+        doc_ids, offsets, targets = self.arrays()
+        linked = doc_ids[targets].tolist()
+        offsets = offsets.tolist()
+        for i, doc_id in enumerate(doc_ids.tolist()):
+            yield doc_id, linked[offsets[i]:offsets[i + 1]]
+
+    def close(self):
+        self.mapped_file.close()
+
+
+def write_term_table(token_retrieval_offset_map, filepath):
+    # Sorted term dictionary: term count, uint64 term offsets (+1), fixed size records, term bytes.
+    # Entries are the offset table lists, [offset, length, max score, df] plus the optional
+    # champion tier, as write_token_postings returns them while the postings are written.
+    terms = sorted(token_retrieval_offset_map)
+    encoded = [term.encode('utf-8') for term in terms]
+    offsets = np.zeros(len(terms) + 1, dtype='<u8')
+    np.cumsum([len(term) for term in encoded], out=offsets[1:])
+    records = []
+    for term in terms:
+        entry = token_retrieval_offset_map[term]
+        champion = entry[4:7] if len(entry) == 7 else [0, 0, 0.0]
+        records.append(TERM_RECORD.pack(entry[0], entry[1], entry[2], entry[3], *champion))
+    write_replacing(filepath, [COUNT.pack(len(terms)), offsets.tobytes(), b''.join(records), b''.join(encoded)])
+
+
+class TermTable:
+    def __init__(self, filepath):
+        self.mapped_file = MappedFile(filepath)
+
+    def __len__(self):
+        return COUNT.unpack_from(self.mapped_file.buffer(), 0)[0]
+
+    def terms(self):
+        # All terms in sorted order
+        buffer = self.mapped_file.buffer()
+        count = COUNT.unpack_from(buffer, 0)[0]
+        terms_start = COUNT.size + 8 * (count + 1) + TERM_RECORD.size * count
+        offsets = np.frombuffer(buffer, dtype='<u8', count=count + 1, offset=COUNT.size).tolist()
+        for i in range(count):
+            yield bytes(buffer[terms_start + offsets[i]:terms_start + offsets[i + 1]]).decode('utf-8')
+
+    def find(self, term):
+        # Binary search over the sorted terms, returns the record index or -1
+        buffer = self.mapped_file.buffer()
+        count = COUNT.unpack_from(buffer, 0)[0]
+        terms_start = COUNT.size + 8 * (count + 1) + TERM_RECORD.size * count
+        key = term.encode('utf-8')
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, end = struct.unpack_from('<QQ', buffer, COUNT.size + 8 * mid)
+            if bytes(buffer[terms_start + start:terms_start + end]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < count:
+            start, end = struct.unpack_from('<QQ', buffer, COUNT.size + 8 * lo)
+            if bytes(buffer[terms_start + start:terms_start + end]) == key:
+                return lo
+        return -1
+
+    def get(self, term, default=None):
+        index = self.find(term)
+        if index < 0:
+            return default
+        buffer = self.mapped_file.buffer()
+        count = COUNT.unpack_from(buffer, 0)[0]
+        record = TERM_RECORD.unpack_from(buffer, COUNT.size + 8 * (count + 1) + TERM_RECORD.size * index)
+        offset, length, max_score, df, champion_offset, champion_length, tail_max_score = record
+        if champion_length == 0:
+            return [offset, length, max_score, df]
+        return [offset, length, max_score, df, champion_offset, champion_length, tail_max_score]
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def __getitem__(self, term):
+        entry = self.get(term)
+        if entry is None:
+            raise KeyError(term)
+        return entry
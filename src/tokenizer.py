@@ -2,79 +2,97 @@ import re
 import os
 from nltk.stem import PorterStemmer
 from bs4 import BeautifulSoup
-from collections import defaultdict
+from config import STEM_CACHE_BYTES
+from query_cache import LRUCache
+
+# Tags whose text never makes it into the index
+REMOVED_TAGS = ['script', 'style', 'footer', 'nav', 'meta', 'link']
+
+TOKEN_PATTERN = re.compile(r'\b[a-zA-Z0-9]+\b')
+
+# Estimated bytes of a stem cache entry besides the characters of the word and its
+# stem: the headers of both strings and the cache's OrderedDict entry and tuple
+STEM_ENTRY_BYTES = 256
 
 class Tokenizer:
-    def __init__(self, stop_words=None):
+    def __init__(self, stop_words=None, stem_cache_bytes=STEM_CACHE_BYTES):
         self.ps = PorterStemmer()
-        
+        # word -> stem of the most frequent words. Stemming is the costliest step of
+        # tokenizing and the same few thousand words make up most of every page.
+        self.stems = LRUCache(stem_cache_bytes, size_of=lambda stem: STEM_ENTRY_BYTES + 2 * len(stem))
+
         self.title_weight = 2.0
         self.h1_weight = 2.0
         self.h2_weight = 1.5
         self.h3_weight = 1.5
         self.bold_weight = 1.5
         self.main_weight = 1.0
-        
+
         self.stop_words = stop_words if stop_words else set()
 
+    def stem(self, word):
+        stem = self.stems.get(word)
+        if stem is None:
+            stem = self.ps.stem(word)
+            self.stems.put(word, stem)
+        return stem
+
     def tokenize_and_filter(self, text):
-        tokens = re.findall(r'\b[a-zA-Z0-9]+\b', text.lower())
-        tokens = [self.ps.stem(tok) for tok in tokens]
-        return tokens
+        return [self.stem(tok) for tok in TOKEN_PATTERN.findall(text.lower())]
+
+    def extract_fields(self, soup):
+        # Expects a soup that already had REMOVED_TAGS decomposed
+        return {
+            'title': ' '.join(t.get_text() for t in soup.find_all('title')),
+            'h1': ' '.join(t.get_text() for t in soup.find_all('h1')),
+            'h2': ' '.join(t.get_text() for t in soup.find_all('h2')),
+            'h3': ' '.join(t.get_text() for t in soup.find_all('h3')),
+            'bold': ' '.join(t.get_text() for t in soup.find_all(['b', 'strong'])),
+            'main': soup.get_text(),
+        }
 
     def tokenize_with_positions_and_weights(self, html_content):
         soup = BeautifulSoup(html_content, 'html.parser')
-        
+
         # Remove unwanted tags
-        for tag in soup(['script', 'style', 'footer', 'nav', 'meta', 'link']):
+        for tag in soup(REMOVED_TAGS):
             tag.decompose()
 
-        title_text = ' '.join(t.get_text() for t in soup.find_all('title'))
-        h1_text = ' '.join(t.get_text() for t in soup.find_all('h1'))
-        h2_text = ' '.join(t.get_text() for t in soup.find_all('h2'))
-        h3_text = ' '.join(t.get_text() for t in soup.find_all('h3'))
-        bold_text = ' '.join(t.get_text() for t in soup.find_all(['b', 'strong']))
-        main_text = soup.get_text()
-
-        # Tokenize each section
-        title_tokens = self.tokenize_and_filter(title_text)
-        h1_tokens = self.tokenize_and_filter(h1_text)
-        h2_tokens = self.tokenize_and_filter(h2_text)
-        h3_tokens = self.tokenize_and_filter(h3_text)
-        bold_tokens = self.tokenize_and_filter(bold_text)
-        main_tokens = self.tokenize_and_filter(main_text)
-
-        title_set = set(title_tokens)
-        h1_set = set(h1_tokens)
-        h2_set = set(h2_tokens)
-        h3_set = set(h3_tokens)
-        bold_set = set(bold_tokens)
-
-        token_data = defaultdict(lambda: {"weight":0.0, "positions":[]})
-
-        for i, t in enumerate(main_tokens):
-            if t in self.stop_words:
-                occurrence_weight = self.main_weight
-            else:
-                candidate_weights = []
-                if t in title_set:
-                    candidate_weights.append(self.title_weight)
-                if t in h1_set:
-                    candidate_weights.append(self.h1_weight)
-                if t in h2_set:
-                    candidate_weights.append(self.h2_weight)
-                if t in h3_set:
-                    candidate_weights.append(self.h3_weight)
-                if t in bold_set:
-                    candidate_weights.append(self.bold_weight)
+        return self.tokenize_fields(self.extract_fields(soup))
+
+    def tokenize_fields(self, fields):
+        # Every distinct word of the page is stemmed once, and the weight of a token's
+        # occurrences (main text plus the largest weight of the fields it appears in) is
+        # worked out on its first occurrence.
+        stems = {}  # word -> stem, for this page
 
+        def words_of(text):
+            words = TOKEN_PATTERN.findall(text.lower())
+            for word in set(words).difference(stems):
+                stems[word] = self.stem(word)
+            return words
+
+        main_words = words_of(fields['main'])
+        # Field texts are split on their own: a word running across a tag boundary is one
+        # token of the main text but two of the fields
+        field_weights = [(self.title_weight, 'title'), (self.h1_weight, 'h1'), (self.h2_weight, 'h2'),
+                         (self.h3_weight, 'h3'), (self.bold_weight, 'bold')]
+        field_sets = [(weight, {stems[word] for word in words_of(fields[field])}) for weight, field in field_weights]
+
+        token_data = {}  # token -> [weight, [positions]]
+        occurrence_weights = {}
+        for i, word in enumerate(main_words):
+            t = stems[word]
+            data = token_data.get(t)
+            if data is None:
+                data = token_data[t] = [0.0, []]
+                candidate_weights = [] if t in self.stop_words else [weight for weight, field_set in field_sets if t in field_set]
                 if candidate_weights:
-                    occurrence_weight = self.main_weight + max(candidate_weights)
+                    occurrence_weights[t] = self.main_weight + max(candidate_weights)
                 else:
-                    occurrence_weight = self.main_weight
-
-            token_data[t]["weight"] += occurrence_weight
-            token_data[t]["positions"].append(i)
+                    occurrence_weights[t] = self.main_weight
+            data[0] += occurrence_weights[t]
+            data[1].append(i)
 
-        result = {tok: (d["weight"], d["positions"]) for tok, d in token_data.items()}
+        result = {tok: (weight, positions) for tok, (weight, positions) in token_data.items()}
         return result
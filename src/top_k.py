@@ -0,0 +1,295 @@
+import heapq
+import numpy as np
+from bisect import bisect_left
+from collections import Counter
+from proximity import contains_phrase
+
+# Slack for float rounding when an upper bound is compared with the threshold
+BOUND_EPSILON = 1e-9
+
+
+def summed_term_scores(stemmed_terms, doc_scores):
+    # Adds a document's tf-idf scores in query term order, the order score_exhaustive uses
+    score = 0.0
+    for term in stemmed_terms:
+        if term in doc_scores:
+            score += doc_scores[term]
+    return score
+
+
+def max_score_top_k(stemmed_terms, term_postings, limit, pagerank_of, max_pagerank,
+                    proximity_bonus, max_proximity_bonus):
+    # Document-at-a-time MaxScore over the query's posting lists.
+    #
+    # term_postings maps each query term found in the index to (postings, max tf-idf score).
+    # Lists are ordered by their score upper bound. Once the k-th best score (the
+    # threshold) is above what the lowest lists can add up to, together with the largest
+    # PageRank and proximity bonus, those lists become non-essential: they are only
+    # probed (by binary search) for documents found in the essential lists, and only
+    # while the document can still beat the threshold.
+    #
+    # Scores of surviving documents are summed in the same order as score_exhaustive,
+    # and ties go to the lower doc_id, so the result equals the first `limit` entries
+    # of the exhaustive ranking.
+    if not term_postings or limit <= 0:
+        return []
+
+    unique_terms = set(stemmed_terms)
+    bonus_possible = len(stemmed_terms) > 1 and len(unique_terms) > 1 and len(term_postings) == len(unique_terms)
+    max_bonus = max_proximity_bonus if bonus_possible else 0.0
+    term_counts = Counter(stemmed_terms)
+
+    lists = sorted(term_postings.items(), key=lambda item: item[1][1] * term_counts[item[0]])
+    terms = [term for term, _ in lists]
+    postings = [p for _, (p, _) in lists]
+    doc_ids = [p.doc_ids.tolist() for p in postings]
+    scores = [p.scores.tolist() for p in postings]
+    lengths = [len(ids) for ids in doc_ids]
+    weights = [term_counts[term] for term in terms]
+
+    # prefix[j]: upper bound of what lists 0..j can contribute together
+    prefix = []
+    total = 0.0
+    for (term, (_, max_score)) in lists:
+        total += max_score * term_counts[term]
+        prefix.append(total)
+
+    num_lists = len(lists)
+    cursors = [0] * num_lists
+    heap = []  # (score, -doc_id), the worst result on top
+    threshold = float('-inf')
+    first_essential = 0
+
+    while True:
+        doc = None
+        for j in range(first_essential, num_lists):
+            c = cursors[j]
+            if c < lengths[j] and (doc is None or doc_ids[j][c] < doc):
+                doc = doc_ids[j][c]
+        if doc is None:
+            break
+
+        found = {}  # list index -> posting index of doc
+        partial = 0.0
+        has_all = True
+        for j in range(first_essential, num_lists):
+            c = cursors[j]
+            if c < lengths[j] and doc_ids[j][c] == doc:
+                found[j] = c
+                partial += scores[j][c] * weights[j]
+                cursors[j] = c + 1
+            else:
+                has_all = False
+
+        pagerank = pagerank_of(doc)
+        pruned = False
+        for j in range(first_essential - 1, -1, -1):
+            bonus_bound = max_bonus if has_all else 0.0
+            if partial + prefix[j] + pagerank + bonus_bound + BOUND_EPSILON < threshold:
+                pruned = True
+                break
+            c = bisect_left(doc_ids[j], doc, cursors[j], lengths[j])
+            cursors[j] = c
+            if c < lengths[j] and doc_ids[j][c] == doc:
+                found[j] = c
+                partial += scores[j][c] * weights[j]
+            else:
+                has_all = False
+        if pruned:
+            continue
+
+        score = summed_term_scores(stemmed_terms, {terms[j]: scores[j][c] for j, c in found.items()})
+        if bonus_possible and len(found) == num_lists:
+            # Positions are only read for documents the bonus could lift above the threshold
+            if score + max_bonus + pagerank + BOUND_EPSILON < threshold:
+                continue
+            score += proximity_bonus([postings[j].positions_at(c) for j, c in found.items()])
+        score += pagerank
+
+        # Documents arrive in doc_id order, so a later one has to beat the threshold strictly
+        entry = (score, -doc)
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+        else:
+            continue
+
+        if len(heap) == limit:
+            threshold = heap[0][0]
+            while (first_essential < num_lists
+                   and prefix[first_essential] + max_pagerank + max_bonus + BOUND_EPSILON < threshold):
+                first_essential += 1
+
+    return [(-neg_doc, score) for score, neg_doc in sorted(heap, key=lambda e: (-e[0], -e[1]))]
+
+
+def tiered_top_k(stemmed_terms, term_tiers, limit, pagerank_of, max_pagerank,
+                 proximity_bonus, max_proximity_bonus):
+    # Answers the query from the champion tiers alone when that provably gives the exact top k.
+    #
+    # term_tiers maps each query term found in the index to (champion postings, max score
+    # outside the champions), the latter None when the champions are the whole list.
+    # A candidate found in the champions of every term that has a tail is scored exactly.
+    # Everything else (candidates missing from some champion list, and documents in no
+    # champion list at all) only gets an upper bound from the tail maxima. If the k-th
+    # exact score beats every such bound, the top k is complete; otherwise None is
+    # returned and the caller has to read the full lists.
+    if not term_tiers or limit <= 0:
+        return []
+
+    unique_terms = set(stemmed_terms)
+    bonus_possible = len(stemmed_terms) > 1 and len(unique_terms) > 1 and len(term_tiers) == len(unique_terms)
+    max_bonus = max_proximity_bonus if bonus_possible else 0.0
+    term_counts = Counter(stemmed_terms)
+
+    candidates = {}  # doc_id -> {term: posting index in the champion list}
+    term_scores = {}
+    for term, (postings, _) in term_tiers.items():
+        term_scores[term] = postings.scores.tolist()
+        for i, doc in enumerate(postings.doc_ids.tolist()):
+            if doc in candidates:
+                candidates[doc][term] = i
+            else:
+                candidates[doc] = {term: i}
+
+    tails = {term: tail for term, (_, tail) in term_tiers.items() if tail is not None}
+    if tails:
+        bound = sum(tail * term_counts[term] for term, tail in tails.items()) + max_pagerank
+        if len(tails) == len(term_tiers):
+            bound += max_bonus
+    else:
+        bound = float('-inf')
+
+    complete = []  # (upper bound, doc, found)
+    for doc, found in candidates.items():
+        pagerank = pagerank_of(doc)
+        partial = sum(term_scores[term][i] * term_counts[term] for term, i in found.items())
+        unknown = [term for term in tails if term not in found]
+        # A term that is neither found nor possibly in the tail is missing, so no bonus
+        bonus_bound = max_bonus if len(found) + len(unknown) == len(term_tiers) else 0.0
+        if unknown:
+            upper = partial + sum(tails[term] * term_counts[term] for term in unknown) + pagerank + bonus_bound
+            bound = max(bound, upper)
+        else:
+            complete.append((partial + pagerank + bonus_bound, doc, found))
+
+    # Exact scores, best bound first, until no remaining candidate can enter the heap
+    complete.sort(key=lambda c: (-c[0], c[1]))
+    heap = []
+    for upper, doc, found in complete:
+        if len(heap) == limit and upper + BOUND_EPSILON < heap[0][0]:
+            break
+        score = summed_term_scores(stemmed_terms, {term: term_scores[term][i] for term, i in found.items()})
+        if bonus_possible and len(found) == len(term_tiers):
+            score += proximity_bonus([term_tiers[term][0].positions_at(i) for term, i in found.items()])
+        score += pagerank_of(doc)
+
+        entry = (score, -doc)
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    if len(heap) < limit and tails:
+        return None
+    if heap and heap[0][0] <= bound + BOUND_EPSILON:
+        return None
+    return [(-neg_doc, score) for score, neg_doc in sorted(heap, key=lambda e: (-e[0], -e[1]))]
+
+
+def vectorized_top_k(stemmed_terms, term_postings, limit, pagerank_array, proximity_bonus, max_proximity_bonus):
+    # Exhaustive scoring with array operations instead of a dict per posting.
+    # np.add.at adds the scores of each document in query term order, like
+    # score_exhaustive, so the ranking is identical. The proximity bonus is only
+    # computed for documents that could reach the top k with the largest bonus.
+    if not term_postings or limit <= 0:
+        return []
+
+    found_terms = [term for term in stemmed_terms if term in term_postings]
+    doc_ids = np.concatenate([term_postings[term].doc_ids for term in found_terms])
+    scores = np.concatenate([term_postings[term].scores for term in found_terms]).astype(np.float64)
+    docs, inverse = np.unique(doc_ids, return_inverse=True)
+    totals = np.zeros(len(docs))
+    np.add.at(totals, inverse, scores)
+
+    in_range = docs < len(pagerank_array)
+    pageranks = np.zeros(len(docs))
+    pageranks[in_range] = pagerank_array[docs[in_range]]
+
+    unique_terms = set(stemmed_terms)
+    if len(stemmed_terms) > 1 and len(unique_terms) > 1 and len(term_postings) == len(unique_terms):
+        term_counts = np.zeros(len(docs), dtype=np.int32)
+        for term in unique_terms:
+            term_counts[np.searchsorted(docs, term_postings[term].doc_ids)] += 1
+        with_all = np.flatnonzero(term_counts == len(unique_terms))
+        if len(docs) > limit and len(with_all):
+            # Bonuses only raise scores, so the k-th best score without them is a floor
+            # for the final k-th score
+            without_bonus = totals + pageranks
+            floor = np.partition(without_bonus, len(docs) - limit)[len(docs) - limit]
+            with_all = with_all[without_bonus[with_all] + max_proximity_bonus + BOUND_EPSILON >= floor]
+        if len(with_all):
+            indexes = {term: np.searchsorted(term_postings[term].doc_ids, docs[with_all]).tolist() for term in unique_terms}
+            bonuses = np.array([
+                proximity_bonus([term_postings[term].positions_at(indexes[term][n]) for term in unique_terms])
+                for n in range(len(with_all))
+            ])
+            totals[with_all] += bonuses
+
+    # Added after the bonus, in score_exhaustive's order
+    totals += pageranks
+
+    if len(docs) > limit:
+        # Keep everything tied with the k-th score so ties can still go to the lower doc_id
+        kth_score = np.partition(totals, len(totals) - limit)[len(totals) - limit]
+        keep = np.flatnonzero(totals >= kth_score)
+        docs, totals = docs[keep], totals[keep]
+    order = np.lexsort((docs, -totals))[:limit]
+    return list(zip(docs[order].tolist(), totals[order].tolist()))
+
+
+def phrase_top_k(phrase_terms, term_postings, limit, pagerank_of, proximity_bonus, max_proximity_bonus):
+    # Documents with the terms at consecutive positions, in phrase order. They are
+    # scored like the same terms in the other modes (tf-idf summed in sorted term order,
+    # proximity bonus, PageRank), so a phrase result keeps the score it has there.
+    # Candidates are the documents with every term; their positions are only read if
+    # the candidate could enter the top k with the largest bonus.
+    unique_terms = set(phrase_terms)
+    if not phrase_terms or limit <= 0 or len(term_postings) < len(unique_terms):
+        return []
+
+    stemmed_terms = sorted(phrase_terms)
+    bonus_possible = len(stemmed_terms) > 1 and len(unique_terms) > 1
+    max_bonus = max_proximity_bonus if bonus_possible else 0.0
+
+    by_length = sorted(unique_terms, key=lambda term: len(term_postings[term]))
+    docs = term_postings[by_length[0]].doc_ids
+    for term in by_length[1:]:
+        docs = np.intersect1d(docs, term_postings[term].doc_ids, assume_unique=True)
+    indexes = {term: np.searchsorted(term_postings[term].doc_ids, docs) for term in unique_terms}
+    scores = {term: term_postings[term].scores[indexes[term]].tolist() for term in unique_terms}
+    indexes = {term: index.tolist() for term, index in indexes.items()}
+
+    heap = []  # (score, -doc_id), the worst result on top
+    for n, doc in enumerate(docs.tolist()):
+        score = summed_term_scores(stemmed_terms, {term: scores[term][n] for term in unique_terms})
+        pagerank = pagerank_of(doc)
+        if len(heap) == limit and score + max_bonus + pagerank + BOUND_EPSILON < heap[0][0]:
+            continue
+        if len(phrase_terms) > 1:
+            positions = {term: term_postings[term].positions_at(indexes[term][n]) for term in unique_terms}
+            if not contains_phrase(phrase_terms, positions):
+                continue
+            if bonus_possible:
+                score += proximity_bonus([positions[term] for term in unique_terms])
+        score += pagerank
+
+        # Documents arrive in doc_id order, so a later one has to beat the threshold strictly
+        entry = (score, -doc)
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    return [(-neg_doc, score) for score, neg_doc in sorted(heap, key=lambda e: (-e[0], -e[1]))]